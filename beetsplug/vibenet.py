@@ -1,4 +1,5 @@
-import multiprocessing
+import contextlib
+import dataclasses
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import mediafile
@@ -10,9 +11,15 @@ from beets.ui import Subcommand, should_write
 from beets.util import syspath
 from beets.dbcore import types
 
+from vibenet import SessionConfig, get_model
 from vibenet import labels as FIELDS
-from vibenet import load_model
-from vibenet.core import load_audio
+from vibenet.batching import DynamicBatcher
+from vibenet.budget import plan_budget, set_fft_workers
+from vibenet.cache import CachedModel, ResultCache, result_params
+from vibenet.core import InferenceResult
+from vibenet.decode_pool import DecodePool
+from vibenet.decoders import decode_settings
+from vibenet.features import FeatureStore
 
 
 class VibeNetPlugin(BeetsPlugin):
@@ -23,13 +30,53 @@ class VibeNetPlugin(BeetsPlugin):
         
         self.config.add({
             "threads": 0,
+            "cpus": 0,
+            "decode_processes": 0,
+            "batch_size": 8,
+            "batch_wait": 5,
             "auto": True,
-            "force": False
+            "force": False,
+            "window": 0.0,
+            "hop": 0.0,
+            "max_duration": 0.0,
+            "precision": "fp32",
+            "intra_op_threads": 0,
+            "inter_op_threads": 1,
+            "allow_spinning": False,
+            "cpu_mem_arena": True,
+            "mem_pattern": True,
+            "execution_mode": "sequential",
+            "cache": True,
+            "hash": "fast",
+            "features": False,
+            "decoder": "auto",
+            "resample_quality": "HQ",
         })
         
         self.cfg_threads = self.config['threads'].get(int)
+        self.cfg_cpus = self.config['cpus'].get(int)
+        self.cfg_decode_processes = self.config['decode_processes'].get(int)
+        self.cfg_batch_size = self.config['batch_size'].get(int)
+        self.cfg_batch_wait = self.config['batch_wait'].as_number()
         self.cfg_auto = self.config['auto'].get(bool)
         self.cfg_force = self.config['force'].get(bool)
+        self.cfg_window = self.config['window'].as_number() or None
+        self.cfg_hop = self.config['hop'].as_number() or None
+        self.cfg_max_duration = self.config['max_duration'].as_number() or None
+        self.cfg_precision = self.config['precision'].as_choice(['fp32', 'int8'])
+        self.cfg_session = SessionConfig(
+            intra_op_threads=self.config['intra_op_threads'].get(int),
+            inter_op_threads=self.config['inter_op_threads'].get(int),
+            allow_spinning=self.config['allow_spinning'].get(bool),
+            cpu_mem_arena=self.config['cpu_mem_arena'].get(bool),
+            mem_pattern=self.config['mem_pattern'].get(bool),
+            execution_mode=self.config['execution_mode'].as_choice(['sequential', 'parallel']),
+        )
+        self.cfg_cache = self.config['cache'].get(bool)
+        self.cfg_hash = self.config['hash'].as_choice(['fast', 'full'])
+        self.cfg_features = self.config['features'].get(bool)
+        self.cfg_decoder = self.config['decoder'].as_choice(['auto', 'soundfile', 'ffmpeg', 'librosa'])
+        self.cfg_resample_quality = self.config['resample_quality'].as_choice(['QQ', 'LQ', 'MQ', 'HQ', 'VHQ'])
         
         for name in FIELDS:
             field = mediafile.MediaField(
@@ -44,23 +91,59 @@ class VibeNetPlugin(BeetsPlugin):
             # Skip items that already have tags
             items = [it for it in items if any(it.get(f) is None for f in FIELDS)]
 
-        if not threads or threads == 0:
-            threads = multiprocessing.cpu_count()
-            self._log.debug("Adjusting max threads to CPU count: {}", threads)
+        # The decoder settings only apply while these items are scored, not to the rest of beets
+        with decode_settings(self.cfg_decoder, self.cfg_resample_quality):
+            self._score_items(items, threads, dry_run, write_tags)
+
+    def _score_items(self, items: list[Item], threads: int, dry_run: bool, write_tags: bool):
+        # Split the CPUs between worker threads, FFT threads and the ORT intra-op pool
+        budget = plan_budget(threads, cpus=self.cfg_cpus, batch_size=self.cfg_batch_size)
+        threads = budget.workers
+        set_fft_workers(budget.fft_workers)
+        session = dataclasses.replace(self.cfg_session, intra_op_threads=self.cfg_session.intra_op_threads or budget.intra_op_threads)
+        self._log.debug("CPU budget: {}", budget)
 
-        net = load_model()
+        net = get_model(session, precision=self.cfg_precision)
+        cache = CachedModel(net, ResultCache(hash_mode=self.cfg_hash)) if self.cfg_cache else None
+        features = FeatureStore(hash_mode=self.cfg_hash) if self.cfg_features else None
+        params = result_params(self.cfg_window, self.cfg_hop, duration=self.cfg_max_duration)
+        
+        pool = DecodePool(self.cfg_decode_processes, decoder=self.cfg_decoder, resample_quality=self.cfg_resample_quality) if self.cfg_decode_processes else None
+        batcher = None
+        if self.cfg_batch_size > 1:
+            batcher = DynamicBatcher(
+                net, max_batch_size=self.cfg_batch_size, max_wait=self.cfg_batch_wait / 1000,
+                runners=budget.runners, window=self.cfg_window, hop=self.cfg_hop,
+            )
         
         def worker(item) -> tuple[Item, dict]:
             path = syspath(item.path)
-            wf = load_audio(path, 16000)
-            pred = net.predict([wf], 16000)[0]
+            
+            digest = None
+            if cache is not None:
+                digest, cached = cache.lookup(path, params)
+                if cached is not None:
+                    return item, cached.to_dict()
+            
+            if features is not None:
+                mel = features.load(path, lambda: net._prepare(path, None, pool, duration=self.cfg_max_duration), duration=self.cfg_max_duration)
+            else:
+                mel = net._prepare(path, None, pool, duration=self.cfg_max_duration)
+                
+            if batcher is not None:
+                pred = batcher.submit_mel(mel).result()
+            else:
+                pred = InferenceResult.from_logits(net._score([mel], self.cfg_window, self.cfg_hop)[0].tolist())
+                    
+            if cache is not None:
+                cache.store(digest, pred, params)
             scores = pred.to_dict()
             return item, scores
 
         total = len(items)
         finished = 0
         
-        with ThreadPoolExecutor(max_workers=threads) as ex:
+        with cache.cache if cache is not None else contextlib.nullcontext(), pool or contextlib.nullcontext(), batcher or contextlib.nullcontext(), ThreadPoolExecutor(max_workers=threads) as ex:
             futs = {ex.submit(worker, it): i for i, it in enumerate(items)}
             for fut in as_completed(futs):
                 idx = futs[fut]
@@ -0,0 +1,79 @@
+# Script for comparing the INT8 model (see quantize_model.py) against the FP32 model
+#
+# Reports compute_metrics for both models against the held-out distillation labels, then the
+# absolute difference between their final (sigmoid / clipped) outputs. Exits non-zero if any
+# attribute's mean difference exceeds MAX_MEAN_ABS_DELTA or its 99th percentile exceeds
+# MAX_P99_ABS_DELTA, which is the accuracy bound documented in the README.
+
+import sys
+from collections import defaultdict
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from tqdm import tqdm
+
+from vibenet import LIKELIHOODS, labels
+from vibenet.core import SAMPLE_RATE, extract_mel
+from vibenet.train.dataset import FMAWaveformDataset
+from vibenet.train.train_utils import compute_metrics
+
+FP32_MODEL = 'model.onnx'
+INT8_MODEL = 'model.int8.onnx'
+TEST_DIR = 'data/preprocessed/waveforms_distill_test'
+BATCH_SIZE = 32
+MAX_MEAN_ABS_DELTA = 0.01
+MAX_P99_ABS_DELTA = 0.05
+
+def activate(logits):
+    out = np.empty_like(logits)
+    for i, name in enumerate(labels):
+        if name in LIKELIHOODS:
+            out[:, i] = 1 / (1 + np.exp(-logits[:, i]))
+        else:
+            out[:, i] = np.clip(logits[:, i], 0, 1)
+    return out
+
+sessions = {
+    'fp32': ort.InferenceSession(FP32_MODEL),
+    'int8': ort.InferenceSession(INT8_MODEL),
+}
+
+test_ds = FMAWaveformDataset(TEST_DIR)
+
+logits = defaultdict(list)
+targets = []
+
+for i in tqdm(range(0, len(test_ds), BATCH_SIZE)):
+    items = [test_ds[j] for j in range(i, min(i + BATCH_SIZE, len(test_ds)))]
+    x = np.stack([extract_mel(wf.numpy(), SAMPLE_RATE) for wf, _ in items])
+    lengths = np.full(len(items), x.shape[-1], dtype=np.int64)
+
+    for name, sess in sessions.items():
+        logits[name].append(sess.run(None, {'x': x, 'lengths': lengths})[0])
+    targets.append(torch.stack([label for _, label in items]))
+
+targets = torch.cat(targets, dim=0)
+logits = {name: np.concatenate(v, axis=0) for name, v in logits.items()}
+
+for name, out in logits.items():
+    pred = {lbl: torch.from_numpy(out[:, i]) for i, lbl in enumerate(labels)}
+    metrics = compute_metrics(pred, targets)
+
+    print(f"\n=== {name} ===")
+    for task, stats in metrics.items():
+        print(f"[{task}] " + ", ".join(f"{k}={v:.4f}" for k, v in stats.items()))
+
+delta = np.abs(activate(logits['int8']) - activate(logits['fp32']))
+failed = False
+
+print("\n=== |int8 - fp32| ===")
+for i, name in enumerate(labels):
+    mean, p99 = delta[:, i].mean(), np.percentile(delta[:, i], 99)
+    ok = mean <= MAX_MEAN_ABS_DELTA and p99 <= MAX_P99_ABS_DELTA
+    failed |= not ok
+    print(f"{name:<18} mean={mean:.4f} p99={p99:.4f} max={delta[:, i].max():.4f} {'ok' if ok else 'FAIL'}")
+
+if failed:
+    print(f"\nINT8 model exceeds the accuracy bound (mean <= {MAX_MEAN_ABS_DELTA}, p99 <= {MAX_P99_ABS_DELTA})", file=sys.stderr)
+    sys.exit(1)
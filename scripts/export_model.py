@@ -1,29 +1,62 @@
 # Script for exporting model to ONNX
 
+import numpy as np
+import onnx
+import onnxruntime as ort
 import torch
 
 from vibenet import labels
 from vibenet.models.student import EfficientNetRegressor
 
+
+class WithEmbedding(torch.nn.Module):
+    """Exports the trunk embedding as a second output next to the head logits"""
+    def __init__(self, model: EfficientNetRegressor):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor):
+        return self.model(x, lengths, return_embedding=True)
+
+
 model = EfficientNetRegressor()
 checkpoint = torch.load("checkpoints/efficientnet_best.pt")
 model.load_state_dict(checkpoint['state_dict'], strict=False)
 model.eval()
 
 input_tensor = torch.rand((1, 128, 1024)) # [B, n_mels, T]
+lengths = torch.tensor([1024], dtype=torch.int64) # [B], valid frames per row for padded batches
 
 torch.onnx.export(
-    model,
-    (input_tensor,),
+    WithEmbedding(model),
+    (input_tensor, lengths),
     "model.onnx",
-    input_names=["x"],
-    output_names=["out"],
+    input_names=["x", "lengths"],
+    output_names=["out", "embedding"],
     dynamic_axes={
         "x": {0: "batch", 2: "time"},
-        "out": {0: "batch"}
+        "lengths": {0: "batch"},
+        "out": {0: "batch"},
+        "embedding": {0: "batch"}
     },
     opset_version=20,
     export_params=True,
     external_data=False,
     dynamo=True
-)
\ No newline at end of file
+)
+
+# Tell the runtime that padded frames are masked throughout the graph, so it may batch tracks
+# of different lengths (see EfficientNetModel). Graphs without this only batch equal lengths.
+exported = onnx.load("model.onnx")
+onnx.helper.set_model_props(exported, {"vibenet.masked_padding": "1"})
+onnx.save(exported, "model.onnx")
+
+# A padded row must score like the same mel on its own
+sess = ort.InferenceSession("model.onnx")
+mel = np.random.default_rng(0).normal(-40, 20, (1, 128, 960)).astype(np.float32)
+padded = np.concatenate([mel, np.full((1, 128, 40), mel.min(), dtype=np.float32)], axis=-1)
+alone = sess.run(None, {'x': mel, 'lengths': np.array([960])})
+batched = sess.run(None, {'x': np.concatenate([padded, padded[:, :, ::-1]]), 'lengths': np.array([960, 1000])})
+for name, a, b in zip(["out", "embedding"], alone, batched):
+    err = np.abs(a[0] - b[0]).max()
+    assert err <= 1e-5, f"Padding changes {name} by {err}, padded batches would not match unpadded inputs"
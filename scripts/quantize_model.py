@@ -0,0 +1,50 @@
+# Script for quantizing the exported ONNX model (see export_model.py) to INT8
+#
+# Produces a static QDQ model with per-channel INT8 weights and UINT8 activations. Activation
+# ranges are calibrated on mels from the distillation training split, so the held-out test split
+# stays untouched for evaluate_quantized.py. Ship the output as vibenet/artifacts/efficientnet_model.int8.onnx
+# once it passes that script's accuracy gate.
+
+import numpy as np
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod,
+                                      QuantFormat, QuantType, quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from vibenet.core import SAMPLE_RATE, extract_mel
+from vibenet.train.dataset import FMAWaveformDataset
+
+INPUT_MODEL = 'model.onnx'
+PREPROCESSED_MODEL = 'model.preprocessed.onnx'
+OUTPUT_MODEL = 'model.int8.onnx'
+CALIBRATION_DIR = 'data/preprocessed/waveforms_distill_train'
+NUM_CALIBRATION_SAMPLES = 512
+BATCH_SIZE = 16
+
+class MelCalibrationReader(CalibrationDataReader):
+    def __init__(self, dataset, num_samples, batch_size):
+        rng = np.random.default_rng(42)
+        indices = rng.choice(len(dataset), size=min(num_samples, len(dataset)), replace=False)
+        self.batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+        self.dataset = dataset
+
+    def get_next(self):
+        if not self.batches:
+            return None
+
+        idx = self.batches.pop(0)
+        x = np.stack([extract_mel(self.dataset[i][0].numpy(), SAMPLE_RATE) for i in idx])
+        lengths = np.full(len(idx), x.shape[-1], dtype=np.int64)
+        return {'x': x, 'lengths': lengths}
+
+quant_pre_process(INPUT_MODEL, PREPROCESSED_MODEL, skip_symbolic_shape=True)
+
+quantize_static(
+    PREPROCESSED_MODEL,
+    OUTPUT_MODEL,
+    MelCalibrationReader(FMAWaveformDataset(CALIBRATION_DIR), NUM_CALIBRATION_SAMPLES, BATCH_SIZE),
+    quant_format=QuantFormat.QDQ,
+    activation_type=QuantType.QUInt8,
+    weight_type=QuantType.QInt8,
+    per_channel=True,
+    calibrate_method=CalibrationMethod.MinMax,
+)
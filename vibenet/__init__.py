@@ -1,8 +1,14 @@
+from vibenet.config import SessionConfig
+
 labels = ['acousticness', 'danceability', 'energy', 'instrumentalness', 'liveness', 'speechiness', 'valence']
 
 LIKELIHOODS = {'acousticness','liveness','instrumentalness'}
 CONTINUOUS  = {'speechiness', 'danceability','energy','valence'}
 
-def load_model():
+def load_model(config: SessionConfig | None = None, precision: str = "fp32", feature_store=None):
     import vibenet.backends
-    return vibenet.backends.EfficientNetModel() # Only model for now
\ No newline at end of file
+    return vibenet.backends.EfficientNetModel(config=config, precision=precision, feature_store=feature_store) # Only model for now
+
+def get_model(config: SessionConfig | None = None, precision: str = "fp32"):
+    import vibenet.registry
+    return vibenet.registry.get_model(config=config, precision=precision) # Shared across calls
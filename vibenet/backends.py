@@ -1,36 +1,382 @@
+import hashlib
 import importlib.resources as resources
+import os
+import platform
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
 from os import PathLike
-from typing import Any, BinaryIO, Sequence
+from pathlib import Path
+from typing import Any, BinaryIO, Iterable, Iterator, Sequence
 
 import numpy as np
 import onnxruntime as ort
 from numpy import ndarray
 
 from vibenet import labels
-from vibenet.core import InferenceResult, Model, create_batch, extract_mel
+from vibenet.budget import available_cpus, plan_budget, set_thread_fft_workers
+from vibenet.config import SessionConfig, default_cache_dir
+from vibenet.decode_pool import DecodePool
+from vibenet.features import FeatureStore
+from vibenet.core import (HOP_LENGTH, SAMPLE_RATE, InferenceResult, Model,
+                          clip_duration, create_batch, extract_mel,
+                          extract_mel_blocks, extract_mels, window_starts)
+from vibenet.decoders import decode_blocks, default_decoder, is_path
+
+
+ARTIFACTS = {
+    "fp32": "efficientnet_model.onnx",
+    "int8": "efficientnet_model.int8.onnx", # Static QDQ, see scripts/quantize_model.py
+}
+
+
+def _buckets(lengths: Sequence[int], batch_size: int, max_padding: float) -> list[list[int]]:
+    """Group indices into batches of similar length.
+    
+    Indices are visited longest first, and a batch is closed once it is full or the next
+    item would need more than `max_padding` (as a fraction of the batch's longest item)
+    of padding.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    
+    groups: list[list[int]] = []
+    for i in order:
+        if groups:
+            group = groups[-1]
+            longest = lengths[group[0]]
+            if len(group) < batch_size and longest - lengths[i] <= max_padding * longest:
+                group.append(i)
+                continue
+        groups.append([i])
+    return groups
+
+
+def _session_options(config: SessionConfig) -> ort.SessionOptions:
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.intra_op_num_threads = config.intra_op_threads or available_cpus() # ORT's own default counts every host core
+    so.inter_op_num_threads = config.inter_op_threads
+    so.enable_cpu_mem_arena = config.cpu_mem_arena
+    so.enable_mem_pattern = config.mem_pattern
+    
+    if config.execution_mode == "parallel":
+        so.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    else:
+        so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        
+    spin = "1" if config.allow_spinning else "0"
+    so.add_session_config_entry("session.intra_op.allow_spinning", spin)
+    so.add_session_config_entry("session.inter_op.allow_spinning", spin)
+    return so
+
+
+@lru_cache(maxsize=1)
+def _cpu_fingerprint() -> str:
+    """Architecture plus CPU feature flags, since optimized graphs may use ISA-specific kernels"""
+    flags = ""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags = line.split(":", 1)[1]
+                    break
+    except OSError:
+        flags = platform.processor()
+    return f"{platform.machine()}:{' '.join(sorted(flags.split()))}"
+
+
+def _file_digest(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _create_session(model_path: Path, config: SessionConfig, model_hash: str) -> ort.InferenceSession:
+    """Create a session, going through the optimized-model cache if enabled.
+    
+    Cache entries are keyed by the model hash, ORT version and CPU features, so any change
+    to those misses and rebuilds. Entries that fail to load are discarded and rebuilt, and
+    any failure to write the cache falls back to an uncached session.
+    """
+    if not config.cache_optimized_model:
+        return ort.InferenceSession(str(model_path), sess_options=_session_options(config))
+    
+    key = hashlib.sha256(f"{model_hash}|{ort.__version__}|{_cpu_fingerprint()}".encode()).hexdigest()[:16]
+    cache_dir = default_cache_dir() / "models"
+    cached = cache_dir / f"{model_path.stem}-{key}.onnx"
+    
+    if cached.is_file():
+        so = _session_options(config)
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL # Already optimized
+        try:
+            return ort.InferenceSession(str(cached), sess_options=so)
+        except Exception:
+            cached.unlink(missing_ok=True)
+    
+    tmp = None
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Unique per call, so concurrent threads building the same model never share a file
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=f"{cached.name}.", suffix=".tmp")
+        os.close(fd)
+        
+        so = _session_options(config)
+        so.optimized_model_filepath = tmp
+        so.log_severity_level = 3 # ORT warns that the saved graph is hardware specific, which the cache key covers
+        sess = ort.InferenceSession(str(model_path), sess_options=so)
+        os.replace(tmp, cached)
+    except Exception:
+        if tmp is not None:
+            Path(tmp).unlink(missing_ok=True)
+        return ort.InferenceSession(str(model_path), sess_options=_session_options(config))
+    
+    # Drop entries for older models, ORT versions or CPUs
+    for stale in cache_dir.glob(f"{model_path.stem}-*.onnx"):
+        if stale != cached:
+            stale.unlink(missing_ok=True)
+    return sess
 
 
 class EfficientNetModel(Model):
-    def __init__(self):
-        with resources.path("vibenet.artifacts", "efficientnet_model.onnx") as model_path:
-            so = ort.SessionOptions()
-            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            so.intra_op_num_threads = 1
-            so.inter_op_num_threads = 1
-                    
-            self.ort_sess = ort.InferenceSession(str(model_path))
+    def __init__(
+        self,
+        config: SessionConfig | None = None,
+        precision: str = "fp32",
+        batch_size: int = 16,
+        max_padding: float = 0.05,
+        feature_store: FeatureStore | None = None,
+    ):
+        if precision not in ARTIFACTS:
+            raise ValueError(f"Unknown precision {precision!r}, expected one of {list(ARTIFACTS)}")
+        
+        self.config = config or SessionConfig()
+        self.precision = precision
+        self.artifact = ARTIFACTS[precision]
+        
+        with resources.path("vibenet.artifacts", ARTIFACTS[precision]) as model_path:
+            if not model_path.is_file():
+                raise FileNotFoundError(f"No {precision} model artifact found at {model_path}")
+            
+            self.model_hash = _file_digest(model_path)
+            self.ort_sess = _create_session(model_path, self.config, self.model_hash)
+            
+        self.batch_size = batch_size
+        self.feature_store = feature_store
+        
+        # Graphs marked `vibenet.masked_padding` ignore frames past `lengths` in every layer, so
+        # tracks of different lengths can share a padded batch. Others (including early graphs
+        # that took `lengths` but only masked the final pool) see the padding, so only mels of
+        # identical length are batched together.
+        self.masked = any(i.name == 'lengths' for i in self.ort_sess.get_inputs())
+        padding_safe = self.masked and self.ort_sess.get_modelmeta().custom_metadata_map.get('vibenet.masked_padding') == '1'
+        self.max_padding = max_padding if padding_safe else 0.0
+        
+        # Graphs exported before the embedding output only have the logits
+        outputs = {o.name: o for o in self.ort_sess.get_outputs()}
+        self.embedding_dim: int | None = outputs['embedding'].shape[-1] if 'embedding' in outputs else None
             
     def predict(
         self,
         inputs: str | Sequence[str] | PathLike[Any] | Sequence[PathLike[Any]] | BinaryIO | Sequence[BinaryIO] | ndarray | Sequence[ndarray],
         sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        return_embedding: bool = False,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
     ) -> list[InferenceResult]:
-        batch = create_batch(inputs, sr=sr)
+        items = inputs if isinstance(inputs, (list, tuple)) else [inputs]
+        duration = clip_duration(duration, max_duration)
+        mels = self._prepare_all(items, sr, offset, duration)
+        rows = self._score(mels, window, hop, return_embedding)
         
-        results = []
+        return [self._result(row, return_embedding) for row in rows]
+    
+    def embed(
+        self,
+        inputs: str | Sequence[str] | PathLike[Any] | Sequence[PathLike[Any]] | BinaryIO | Sequence[BinaryIO] | ndarray | Sequence[ndarray],
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
+    ) -> ndarray:
+        items = inputs if isinstance(inputs, (list, tuple)) else [inputs]
+        duration = clip_duration(duration, max_duration)
+        mels = self._prepare_all(items, sr, offset, duration)
+        return self._score(mels, window, hop, embed=True)[:, len(labels):]
+    
+    def predict_iter(
+        self,
+        inputs: Iterable[Any],
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        *,
+        max_in_flight: int = 8,
+        workers: int | None = None,
+        decode_pool: DecodePool | None = None,
+        return_embedding: bool = False,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
+    ) -> Iterator[tuple[Any, InferenceResult | Exception]]:
+        # Decoding and mel extraction run on `workers` threads (with decoding itself handed to
+        # `decode_pool`'s processes if given), while the calling thread scores whatever mels are
+        # ready as one batch. `inputs` is only pulled as slots free up. The workers split the
+        # CPUs between them for their FFTs, rather than each using all of them.
+        it = iter(inputs)
+        duration = clip_duration(duration, max_duration)
+        pending: dict[Future, Any] = {}
+        exhausted = False
+        budget = plan_budget(workers or min(max_in_flight, available_cpus()))
+        ex = ThreadPoolExecutor(max_workers=budget.workers, initializer=set_thread_fft_workers, initargs=(budget.fft_workers,))
+        
+        try:
+            while True:
+                while not exhausted and len(pending) < max(1, max_in_flight):
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[ex.submit(self._prepare, item, sr, decode_pool, offset, duration)] = item
+                    
+                if not pending:
+                    return
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                
+                ready = []
+                for fut in done:
+                    item = pending.pop(fut)
+                    try:
+                        ready.append((item, fut.result()))
+                    except Exception as e:
+                        yield item, e
+                        
+                for b in range(0, len(ready), self.batch_size):
+                    chunk = ready[b:b + self.batch_size]
+                    try:
+                        rows = self._score([mel for _, mel in chunk], window, hop, return_embedding)
+                    except Exception as e:
+                        for item, _ in chunk:
+                            yield item, e
+                        continue
+                    
+                    for (item, _), row in zip(chunk, rows):
+                        yield item, self._result(row, return_embedding)
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+    
+    def _prepare(
+        self,
+        item,
+        sr: int | None,
+        decode_pool: DecodePool | None = None,
+        offset: float = 0.0,
+        duration: float | None = None,
+    ) -> ndarray:
+        extract = lambda: self._extract(item, sr, decode_pool, offset, duration)
+        if self.feature_store is not None:
+            return self.feature_store.load(item, extract, offset, duration)
+        return extract()
+    
+    def _prepare_all(self, items: Sequence[Any], sr: int | None, offset: float, duration: float | None) -> list[ndarray]:
+        """`_prepare` each item, with in-memory waveforms sharing one batched mel extraction"""
+        mels: list[ndarray | None] = [None] * len(items)
+        arrays = [i for i, item in enumerate(items) if isinstance(item, ndarray)]
+        if len(arrays) > 1:
+            waveforms = create_batch([items[i] for i in arrays], sr=sr, offset=offset, duration=duration)
+            batch, lengths = extract_mels(waveforms, SAMPLE_RATE)
+            for i, mel, n in zip(arrays, batch, lengths):
+                mels[i] = mel[:, :n]
+        return [mel if mel is not None else self._prepare(item, sr, offset=offset, duration=duration) for mel, item in zip(mels, items)]
+    
+    def _extract(self, item, sr: int | None, decode_pool: DecodePool | None, offset: float, duration: float | None) -> ndarray:
+        if decode_pool is not None and not isinstance(item, ndarray):
+            with decode_pool.load(item, offset, duration) as wf:
+                return extract_mel(wf.array, SAMPLE_RATE)
+            
+        if is_path(item):
+            # Decode and compute the mel block by block rather than holding the whole waveform
+            return extract_mel_blocks(decode_blocks(item, SAMPLE_RATE, default_decoder(), offset, duration), SAMPLE_RATE)
+        return extract_mel(create_batch([item], sr=sr, offset=offset, duration=duration)[0], SAMPLE_RATE)
+    
+    def _score(self, mels: Sequence[ndarray], window: float | None, hop: float | None, embed: bool = False) -> ndarray:
+        """Return `[N, 7]` logits, or with `embed`, `[N, 7 + embedding_dim]` logits followed by embeddings"""
+        if embed and self.embedding_dim is None:
+            raise RuntimeError("This model artifact has no embedding output, re-export it with scripts/export_model.py")
         
-        for wf in batch:
-            mel = extract_mel(wf, 16000)
-            outputs = self.ort_sess.run(None, {'x': mel[np.newaxis, :]})
-            results.append(InferenceResult.from_logits([outputs[0][0][i].item() for i, _ in enumerate(labels)])) # type: ignore[index]
-        return results
\ No newline at end of file
+        if not window:
+            return self._run(mels, embed)
+        
+        size = max(1, round(window * SAMPLE_RATE / HOP_LENGTH))
+        step = max(1, round(hop * SAMPLE_RATE / HOP_LENGTH)) if hop else size
+        return self._run_windowed(mels, size, step, embed)
+    
+    def _result(self, row: ndarray, embed: bool) -> InferenceResult:
+        n = len(labels)
+        return InferenceResult.from_logits(row[:n].tolist(), embedding=row[n:].copy() if embed else None)
+    
+    def _width(self, embed: bool) -> int:
+        return len(labels) + ((self.embedding_dim or 0) if embed else 0)
+    
+    def _run(self, mels: Sequence[ndarray], embed: bool = False) -> ndarray:
+        """Run the session over `[n_mels, T]` mels in padded batches, returning `[N, 7]` logits
+        (plus embeddings if `embed`)"""
+        out = np.empty((len(mels), self._width(embed)), dtype=np.float32)
+        lengths = [m.shape[-1] for m in mels]
+        
+        for group in _buckets(lengths, self.batch_size, self.max_padding):
+            T = lengths[group[0]]
+            x = np.empty((len(group), mels[group[0]].shape[0], T), dtype=np.float32)
+            
+            for j, i in enumerate(group):
+                x[j, :, :lengths[i]] = mels[i]
+                x[j, :, lengths[i]:] = mels[i].min() # Pad with the track's silence floor
+                
+            out[group] = self._forward(x, [lengths[i] for i in group], embed)
+        return out
+    
+    def _run_windowed(self, mels: Sequence[ndarray], size: int, hop: int, embed: bool = False) -> ndarray:
+        """Like `_run`, but score `size`-frame windows and average their logits per track.
+        
+        Windows from all tracks are batched together, so the session only ever sees
+        `[batch_size, n_mels, size]` inputs and its memory use does not grow with track length.
+        Embeddings, if requested, are averaged the same way.
+        """
+        out = np.zeros((len(mels), self._width(embed)), dtype=np.float32)
+        counts = np.zeros(len(mels), dtype=np.float32)
+        
+        # Tracks that fit in one window are scored whole
+        short = [i for i, m in enumerate(mels) if m.shape[-1] <= size]
+        if short:
+            out[short] = self._run([mels[i] for i in short], embed)
+            counts[short] = 1
+            
+        windows = [
+            (i, start)
+            for i, m in enumerate(mels) if m.shape[-1] > size
+            for start in window_starts(m.shape[-1], size, hop)
+        ]
+        
+        for b in range(0, len(windows), self.batch_size):
+            chunk = windows[b:b + self.batch_size]
+            x = np.stack([mels[i][:, start:start + size] for i, start in chunk])
+            idx = [i for i, _ in chunk]
+            
+            np.add.at(out, idx, self._forward(x, [size] * len(chunk), embed))
+            np.add.at(counts, idx, 1)
+            
+        return out / counts[:, np.newaxis]
+    
+    def _forward(self, x: ndarray, lengths: Sequence[int], embed: bool = False) -> ndarray:
+        feeds = {'x': x}
+        if self.masked:
+            feeds['lengths'] = np.asarray(lengths, dtype=np.int64)
+            
+        if not embed:
+            return self.ort_sess.run(['out'], feeds)[0]
+        return np.concatenate(self.ort_sess.run(['out', 'embedding'], feeds), axis=1)
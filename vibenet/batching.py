@@ -0,0 +1,125 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+
+import numpy as np
+
+from vibenet.backends import EfficientNetModel
+from vibenet.core import InferenceResult
+
+_STOP = object()
+
+
+class DynamicBatcher:
+    """Gather single-track requests from many threads or coroutines into batched inference
+
+    Callers decode and extract mels on their own thread, then queue them. A runner thread
+    takes the first queued mel and waits up to `max_wait` seconds for more, up to
+    `max_batch_size`, before scoring them all with one session run and handing each caller
+    its result. With `runners > 1` several batches can be in the session at once.
+    """
+    def __init__(
+        self,
+        model: EfficientNetModel,
+        max_batch_size: int = 16,
+        max_wait: float = 0.005,
+        runners: int = 1,
+        window: float | None = None,
+        hop: float | None = None,
+    ):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.window = window
+        self.hop = hop
+
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock() # Orders submits against close, so nothing is queued behind _STOP
+        self._runners = [
+            threading.Thread(target=self._run, name=f"vibenet-batcher-{i}", daemon=True)
+            for i in range(max(1, runners))
+        ]
+        for t in self._runners:
+            t.start()
+
+    def submit(self, item: Any, sr: int | None = None) -> "Future[InferenceResult]":
+        """Decode `item` on the calling thread and queue it, returning a future for its result"""
+        return self.submit_mel(self.model._prepare(item, sr))
+
+    def submit_mel(self, mel: np.ndarray) -> "Future[InferenceResult]":
+        fut: Future[InferenceResult] = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("DynamicBatcher is closed")
+            self._queue.put((mel, fut))
+        return fut
+
+    def predict(self, item: Any, sr: int | None = None) -> InferenceResult:
+        return self.submit(item, sr).result()
+
+    async def apredict(self, item: Any, sr: int | None = None) -> InferenceResult:
+        loop = asyncio.get_running_loop()
+        mel = await loop.run_in_executor(None, self.model._prepare, item, sr)
+        return await asyncio.wrap_future(self.submit_mel(mel))
+
+    def close(self):
+        """Stop accepting work, finish what is queued and stop the runners"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._runners:
+                self._queue.put(_STOP)
+
+        for t in self._runners:
+            t.join()
+
+    def __enter__(self) -> "DynamicBatcher":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+
+            batch = [job]
+            stop = False
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stop = True
+                    break
+                batch.append(job)
+
+            self._score(batch)
+            if stop:
+                return
+
+    def _score(self, batch: list[tuple[np.ndarray, Future]]):
+        batch = [(mel, fut) for mel, fut in batch if fut.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            logits = self.model._score([mel for mel, _ in batch], self.window, self.hop)
+        except Exception as e:
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+
+        for (_, fut), row in zip(batch, logits):
+            fut.set_result(InferenceResult.from_logits(row.tolist()))
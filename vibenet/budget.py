@@ -0,0 +1,130 @@
+import math
+import os
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+_CGROUP_ROOT = Path("/sys/fs/cgroup")
+_PROC_CGROUP = Path("/proc/self/cgroup")
+
+_fft_workers: int | None = None
+_thread = threading.local()
+
+
+def _read(path: Path) -> str | None:
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_quota() -> float | None:
+    """The CPU limit in CPUs set on this process's cgroup or its ancestors, if any"""
+    limits = []
+    for line in (_read(_PROC_CGROUP) or "").splitlines():
+        _, controllers, rel = line.split(":", 2)
+        if controllers == "": # cgroup v2
+            base, files = _CGROUP_ROOT, ("cpu.max",)
+        elif "cpu" in controllers.split(","): # cgroup v1
+            base, files = _CGROUP_ROOT / controllers, ("cpu.cfs_quota_us", "cpu.cfs_period_us")
+        else:
+            continue
+
+        # Containers usually mount their own cgroup at the root, hosts show the full path
+        rel_path = Path(rel.lstrip("/"))
+        for d in {base, *(base / p for p in [rel_path, *rel_path.parents])}:
+            if len(files) == 1:
+                quota, _, period = (_read(d / files[0]) or "max").partition(" ")
+            else:
+                quota, period = _read(d / files[0]) or "-1", _read(d / files[1]) or ""
+            if quota not in ("max", "-1") and period:
+                limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+
+@lru_cache(maxsize=1)
+def available_cpus() -> int:
+    """CPUs this process can actually use
+
+    `$VIBENET_CPUS` if set, otherwise the CPUs in the process's affinity mask, capped by any
+    cgroup CPU quota (as set by `docker run --cpus` or Kubernetes limits). `os.cpu_count()`
+    counts every core of the host instead.
+    """
+    if "VIBENET_CPUS" in os.environ:
+        return max(1, int(os.environ["VIBENET_CPUS"]))
+
+    n = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else 0
+    n = n or os.cpu_count() or 1
+    try:
+        quota = _cgroup_quota()
+    except (ValueError, ZeroDivisionError):
+        quota = None # Unexpected cgroup file contents
+    if quota is not None:
+        n = min(n, max(1, math.ceil(quota)))
+    return n
+
+
+@dataclass(frozen=True)
+class CpuBudget:
+    """How many threads each stage of the pipeline gets out of `cpus`
+
+    Args:
+        cpus: CPUs to share out
+        workers: Threads decoding files, each also computing spectrograms
+        runners: Threads running the session on batches alongside the workers, or 0 when
+            each worker runs it itself
+        fft_workers: Threads per rfft call in spectrogram extraction
+        intra_op_threads: ONNX Runtime threads per session run
+    """
+    cpus: int
+    workers: int
+    runners: int
+    fft_workers: int
+    intra_op_threads: int
+
+
+def plan_budget(workers: int = 0, runners: int = 0, cpus: int = 0, batch_size: int = 1) -> CpuBudget:
+    """Split `cpus` (0 = `available_cpus()`) between decode workers, FFT and ONNX Runtime threads
+
+    Without `runners`, each worker runs the session between its own decodes, so the stages
+    take turns and each worker gets `cpus / workers` threads for both (`workers` defaults to
+    one per CPU). With `batch_size > 1`, `runners` defaults to one per `batch_size` workers.
+
+    Runners score batches while the workers decode, so the two stages split the CPUs rather
+    than each assuming it has all of them. Decoding plus spectrograms take about as long per
+    track as inference, so by default the runners get half the CPUs and the workers the
+    rest. An explicit `workers` leaves the runners what is left over (at least one thread each).
+    """
+    cpus = cpus or available_cpus()
+    if not runners and batch_size > 1:
+        runners = max(1, (workers or cpus) // batch_size)
+    if not runners:
+        workers = workers or cpus
+        share = max(1, cpus // workers)
+        return CpuBudget(cpus=cpus, workers=workers, runners=0, fft_workers=share, intra_op_threads=share)
+
+    ort = max(runners, cpus - workers if workers else cpus // 2)
+    workers = workers or max(1, cpus - ort)
+    return CpuBudget(
+        cpus=cpus,
+        workers=workers,
+        runners=runners,
+        fft_workers=max(1, (cpus - ort) // workers),
+        intra_op_threads=max(1, ort // runners),
+    )
+
+
+def fft_workers() -> int:
+    """Threads per rfft call on this thread: `set_thread_fft_workers`, else `set_fft_workers`, else `available_cpus()`"""
+    return getattr(_thread, "fft_workers", None) or _fft_workers or available_cpus()
+
+
+def set_fft_workers(n: int | None):
+    global _fft_workers
+    _fft_workers = n
+
+
+def set_thread_fft_workers(n: int | None):
+    """Override `fft_workers` for the calling thread, e.g. as a thread pool's initializer"""
+    _thread.fft_workers = n
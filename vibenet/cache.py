@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from os import PathLike
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Literal
+
+import numpy as np
+
+from vibenet.config import default_cache_dir
+from vibenet.core import AudioInput, InferenceResult, Model, clip_duration
+from vibenet.decoders import decoder_key
+from vibenet.resample import default_quality
+
+HashMode = Literal["fast", "full"]
+
+BLOCK_SIZE = 256 * 1024
+
+_STOP = object()
+
+
+def file_digest(path: str | bytes | PathLike, mode: HashMode = "fast") -> str:
+    """Content hash of an audio file
+
+    "fast" hashes the file size plus its first and last `BLOCK_SIZE` bytes, which is enough to
+    tell audio files apart without reading them. "full" hashes the whole file.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if mode == "full":
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+            return f"full:{h.hexdigest()}"
+
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        h.update(f.read(BLOCK_SIZE))
+        if size > 2 * BLOCK_SIZE:
+            f.seek(-BLOCK_SIZE, os.SEEK_END)
+        h.update(f.read(BLOCK_SIZE))
+    return f"fast:{h.hexdigest()}"
+
+
+class ResultCache:
+    """On-disk cache of `InferenceResult`s keyed by audio content and model
+
+    Entries are keyed by the file's content hash, the model artifact hash and a `params` string
+    for anything else that changes the output (e.g. windowing). Results from older versions of
+    an artifact are dropped by `invalidate`, while other artifacts (such as the fp32 and int8
+    models) keep theirs. The least recently used entries are evicted past `max_entries`.
+    Safe to share between threads and processes.
+    """
+    def __init__(self, path: Path | None = None, max_entries: int = 1_000_000, hash_mode: HashMode = "fast"):
+        self.path = path or default_cache_dir() / "results.sqlite3"
+        self.max_entries = max_entries
+        self.hash_mode = hash_mode
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                digest TEXT NOT NULL,
+                model TEXT NOT NULL,
+                params TEXT NOT NULL,
+                scores TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                artifact TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (digest, model, params)
+            )
+        """)
+        # Databases from before artifacts were recorded lack the column
+        if "artifact" not in {row[1] for row in self._db.execute("PRAGMA table_info(results)")}:
+            self._db.execute("ALTER TABLE results ADD COLUMN artifact TEXT NOT NULL DEFAULT ''")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def digest(self, path: str | bytes | PathLike) -> str:
+        return file_digest(path, self.hash_mode)
+
+    def get(self, digest: str, model: str, params: str = "") -> InferenceResult | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT scores FROM results WHERE digest = ? AND model = ? AND params = ?",
+                (digest, model, params),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE results SET last_used = ? WHERE digest = ? AND model = ? AND params = ?",
+                (time.time(), digest, model, params),
+            )
+        return InferenceResult(**json.loads(row[0]))
+
+    def put(self, digest: str, model: str, result: InferenceResult, params: str = "", artifact: str = ""):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (digest, model, params, scores, last_used, artifact) VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, model, params, json.dumps(result.to_dict()), time.time(), artifact),
+            )
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                self._evict()
+
+    def invalidate(self, model: str, artifact: str = ""):
+        """Drop entries computed by versions of `artifact` other than the one hashing to `model`
+
+        Entries stored before artifacts were recorded are dropped too.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM results WHERE artifact IN (?, '') AND model != ?", (artifact, model))
+
+    def _evict(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._db.close()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def result_params(
+    window: float | None = None,
+    hop: float | None = None,
+    offset: float = 0.0,
+    duration: float | None = None,
+) -> str:
+    """Key for the prediction options that change a file's result"""
+    params = f"window={window or 0}:hop={hop or 0}"
+    if offset or duration is not None:
+        params += f":offset={offset:g}:duration={duration if duration is not None else 'end'}"
+    if (quality := default_quality()) != "HQ":
+        params += f":resample={quality}"
+    return params
+
+
+class CachedModel(Model):
+    """Wraps a model so file inputs found in `cache` are answered without decoding
+
+    Waveform and file-handle inputs have no stable identity and always go to the model.
+    """
+    def __init__(self, model: Any, cache: ResultCache):
+        self.model = model
+        self.cache = cache
+        self.model_hash: str = model.model_hash
+        self.artifact: str = model.artifact
+        cache.invalidate(self.model_hash, self.artifact)
+
+    def lookup(self, item, params: str = "") -> tuple[str | None, InferenceResult | None]:
+        """Return `(digest, result)` for a file input, with `result` None on a miss
+
+        `params` comes from `result_params`. Files decoded by a backend other than libsndfile
+        get their own digest, since the waveforms (and so the results) differ slightly.
+        """
+        if not isinstance(item, (str, bytes, PathLike)):
+            return None, None
+        try:
+            digest = self.cache.digest(item)
+        except OSError:
+            return None, None # Let the model report the error
+        if backend := decoder_key(item):
+            digest += f":{backend}"
+        return digest, self.cache.get(digest, self.model_hash, params)
+
+    def store(self, digest: str | None, result: InferenceResult, params: str = ""):
+        if digest is not None:
+            self.cache.put(digest, self.model_hash, result, params, self.artifact)
+
+    def predict(
+        self,
+        inputs: AudioInput,
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        return_embedding: bool = False,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
+    ) -> list[InferenceResult]:
+        duration = clip_duration(duration, max_duration)
+        kwargs = dict(window=window, hop=hop, offset=offset, duration=duration)
+        if return_embedding:
+            return self.model.predict(inputs, sr, return_embedding=True, **kwargs) # Embeddings aren't cached
+        
+        params = result_params(window, hop, offset, duration)
+        items = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+        lookups = [self.lookup(item, params) for item in items]
+
+        misses = [i for i, (_, res) in enumerate(lookups) if res is None]
+        if misses:
+            computed = self.model.predict([items[i] for i in misses], sr, **kwargs)
+            for i, res in zip(misses, computed):
+                self.store(lookups[i][0], res, params)
+                lookups[i] = (lookups[i][0], res)
+
+        return [res for _, res in lookups] # type: ignore[misc]
+
+    def embed(self, inputs: AudioInput, sr: int | None = None, **kwargs) -> np.ndarray:
+        return self.model.embed(inputs, sr, **kwargs)
+
+    def predict_iter(
+        self,
+        inputs: Iterable[Any],
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        **kwargs,
+    ) -> Iterator[tuple[Any, InferenceResult | Exception]]:
+        if kwargs.get("return_embedding"):
+            yield from self.model.predict_iter(inputs, sr, window=window, hop=hop, **kwargs)
+            return
+
+        kwargs["duration"] = clip_duration(kwargs.get("duration"), kwargs.pop("max_duration", None))
+        params = result_params(window, hop, kwargs.get("offset", 0.0), kwargs["duration"])
+        # The model runs on its own thread so hits can be yielded while misses are still
+        # decoding. Misses are handed over through `pending`, and at most `limit` of them are
+        # outstanding at a time so the input is still read lazily.
+        pending: queue.Queue = queue.Queue()
+        done: queue.Queue = queue.Queue()
+        limit = 2 * max(1, kwargs.get("max_in_flight", 8))
+        outstanding = 0
+        # Digests of the outstanding misses, per item object in the order they were queued. The
+        # model yields its results out of order, but the same object (e.g. a repeated path
+        # string) always comes back with the same digest.
+        digests: defaultdict[int, deque[str | None]] = defaultdict(deque)
+
+        def misses():
+            while (item := pending.get()) is not _STOP:
+                yield item
+
+        def run():
+            try:
+                for pair in self.model.predict_iter(misses(), sr, window=window, hop=hop, **kwargs):
+                    done.put(pair)
+            except BaseException as e:
+                done.put((_STOP, e))
+            else:
+                done.put((_STOP, None))
+
+        def finish(item, res):
+            nonlocal outstanding
+            if item is _STOP:
+                raise res or RuntimeError("model stopped before scoring every input")
+            outstanding -= 1
+            queued = digests[id(item)]
+            digest = queued.popleft() if queued else None
+            if not queued:
+                del digests[id(item)]
+            if isinstance(res, InferenceResult):
+                self.store(digest, res, params)
+            return item, res
+
+        worker = threading.Thread(target=run, name="vibenet-cache", daemon=True)
+        worker.start()
+        try:
+            for item in inputs:
+                digest, res = self.lookup(item, params)
+                if res is not None:
+                    yield item, res
+                else:
+                    while outstanding >= limit:
+                        yield finish(*done.get())
+                    digests[id(item)].append(digest)
+                    outstanding += 1
+                    pending.put(item)
+                while not done.empty():
+                    yield finish(*done.get())
+
+            pending.put(_STOP)
+            while outstanding:
+                yield finish(*done.get())
+        finally:
+            pending.put(_STOP) # Lets the model's iterator end if the caller stopped early
@@ -1,11 +1,11 @@
+import contextlib
 import csv
 import json
-import os
 import sys
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Iterator, Optional
 
 import typer
 from rich.console import Console
@@ -14,14 +14,48 @@ from rich.table import Table
 from typing_extensions import Annotated
 
 import vibenet
-from vibenet import load_model
-from vibenet.core import Model, load_audio
+from vibenet import SessionConfig, load_model
+from vibenet import daemon
+from vibenet.budget import plan_budget, set_fft_workers
+
+# Model code pulls in librosa and onnxruntime, which dominate startup time. It is only
+# imported once we know the work won't be forwarded to a running daemon.
+if TYPE_CHECKING:
+    from vibenet.backends import EfficientNetModel
+    from vibenet.batching import DynamicBatcher
+    from vibenet.cache import CachedModel
+    from vibenet.decode_pool import DecodePool
 
 
 class OutputFormat(str, Enum):
     table = "table"
     json = "json"
     csv = "csv"
+    
+class Precision(str, Enum):
+    fp32 = "fp32"
+    int8 = "int8"
+    
+class ExecutionMode(str, Enum):
+    sequential = "sequential"
+    parallel = "parallel"
+    
+class Decoder(str, Enum):
+    auto = "auto"
+    soundfile = "soundfile"
+    ffmpeg = "ffmpeg"
+    librosa = "librosa"
+    
+class HashMode(str, Enum):
+    fast = "fast"
+    full = "full"
+    
+class ResampleQuality(str, Enum):
+    QQ = "QQ"
+    LQ = "LQ"
+    MQ = "MQ"
+    HQ = "HQ"
+    VHQ = "VHQ"
 
 SR = 16000
 
@@ -49,11 +83,78 @@ def _iter_audio_paths(inputs: list[str], recursive: bool, pattern: str|None, qui
     return list(sorted(set(paths)))
 
 
-def _process_one(path, net: Model):
-    wf = load_audio(path, 16000)
-    scores = net.predict([wf], 16000)[0]
-    row = {"path": str(path), **scores.to_dict()}
-    return row
+def _process_one(path, net: "EfficientNetModel", window: float | None = None, hop: float | None = None, pool: "DecodePool | None" = None, batcher: "DynamicBatcher | None" = None, cache: "CachedModel | None" = None, offset: float = 0.0, duration: float | None = None):
+    from vibenet.cache import result_params
+    from vibenet.core import InferenceResult
+    
+    digest = None
+    params = result_params(window, hop, offset, duration)
+    if cache is not None:
+        digest, cached = cache.lookup(path, params)
+        if cached is not None:
+            return cached.to_dict()
+    
+    mel = net._prepare(path, None, pool, offset, duration)
+    if batcher is not None:
+        scores = batcher.submit_mel(mel).result()
+    else:
+        scores = InferenceResult.from_logits(net._score([mel], window, hop)[0].tolist())
+            
+    if cache is not None:
+        cache.store(digest, scores, params)
+    return scores.to_dict()
+
+
+def _predict_local(
+    paths: list[Path],
+    config: SessionConfig,
+    precision: str,
+    workers: int,
+    decode_processes: int,
+    batch_size: int,
+    batch_wait: float,
+    runners: int,
+    window: float | None,
+    hop: float | None,
+    hash_mode: str | None,
+    features: bool,
+    offset: float,
+    duration: float | None,
+    decoder: str,
+    resample_quality: str,
+) -> Iterator[tuple[Path, dict[str, Any] | Exception]]:
+    from vibenet.batching import DynamicBatcher
+    from vibenet.cache import CachedModel, ResultCache
+    from vibenet.decode_pool import DecodePool
+    from vibenet.decoders import decode_settings
+    from vibenet.features import FeatureStore
+    
+    net = load_model(config, precision=precision, feature_store=FeatureStore(hash_mode=hash_mode or "fast") if features else None)
+    
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(decode_settings(decoder, resample_quality))
+        cache = None
+        if hash_mode is not None:
+            cache = CachedModel(net, stack.enter_context(ResultCache(hash_mode=hash_mode))) # type: ignore[arg-type]
+        pool = stack.enter_context(DecodePool(decode_processes, decoder=decoder, resample_quality=resample_quality)) if decode_processes else None
+        batcher = None
+        if batch_size > 1:
+            batcher = stack.enter_context(DynamicBatcher(
+                net, max_batch_size=batch_size, max_wait=batch_wait / 1000,
+                runners=runners, window=window, hop=hop,
+            ))
+        ex = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        
+        futures = {ex.submit(_process_one, p, net, window, hop, pool, batcher, cache, offset, duration): p for p in paths}
+        try:
+            for fut in as_completed(futures):
+                try:
+                    yield futures[fut], fut.result()
+                except Exception as e:
+                    yield futures[fut], e
+        finally:
+            for f in futures:
+                f.cancel()
 
 
 @app.command()
@@ -64,35 +165,84 @@ def predict(
     glob: Annotated[Optional[str], typer.Option("--glob", help='Glob pattern, e.g. "*.mp3"')] = None,
     strict: Annotated[bool, typer.Option("--strict", help="Abort on first error.")] = False,
     quiet: Annotated[bool, typer.Option("--quiet", "-q")] = False,
-    workers: Annotated[int, typer.Option("--workers", "-j", help="Number of threads for parallel inference. 0=auto")] = 0
+    workers: Annotated[int, typer.Option("--workers", "-j", help="Number of threads for parallel inference. 0=one per CPU")] = 0,
+    cpus: Annotated[int, typer.Option("--cpus", help="CPUs to split between decoding, spectrograms and inference. 0=what the process may use, including container limits")] = 0,
+    decode_processes: Annotated[int, typer.Option("--decode-processes", "-p", help="Decode audio on this many worker processes instead of in the worker threads. 0=off")] = 0,
+    batch_size: Annotated[int, typer.Option("--batch-size", "-b", help="Batch tracks from concurrent workers into one inference call. 1=off")] = 8,
+    batch_wait: Annotated[float, typer.Option("--batch-wait", help="Milliseconds to wait for a batch to fill.")] = 5,
+    window: Annotated[float, typer.Option("--window", help="Score tracks in windows of this many seconds to bound memory. 0=whole track")] = 0,
+    hop: Annotated[float, typer.Option("--hop", help="Seconds between window starts. 0=same as --window")] = 0,
+    offset: Annotated[float, typer.Option("--offset", help="Seconds to skip at the start of each track.")] = 0,
+    max_duration: Annotated[float, typer.Option("--max-duration", help="Only decode and score this many seconds of each track. 0=whole track")] = 0,
+    precision: Annotated[Precision, typer.Option("--precision", help="Model weights to use. int8 is faster with a small accuracy cost")] = Precision.fp32,
+    intra_op_threads: Annotated[int, typer.Option("--intra-op-threads", help="ONNX Runtime threads per operator. 0=the inference share of the CPUs per inference thread")] = 0,
+    inter_op_threads: Annotated[int, typer.Option("--inter-op-threads", help="ONNX Runtime threads across operators (parallel mode only)")] = 1,
+    spin: Annotated[bool, typer.Option("--spin/--no-spin", help="Let idle ONNX Runtime threads spin-wait for work.")] = False,
+    mem_arena: Annotated[bool, typer.Option("--mem-arena/--no-mem-arena", help="Use ONNX Runtime's CPU memory arena.")] = True,
+    mem_pattern: Annotated[bool, typer.Option("--mem-pattern/--no-mem-pattern", help="Preplan ONNX Runtime allocations per input shape.")] = True,
+    execution_mode: Annotated[ExecutionMode, typer.Option("--execution-mode", help="ONNX Runtime graph execution mode.")] = ExecutionMode.sequential,
+    use_daemon: Annotated[bool, typer.Option("--daemon/--no-daemon", help="Forward to a running `vibenet daemon` if there is one.")] = True,
+    use_cache: Annotated[bool, typer.Option("--cache/--no-cache", help="Reuse results for files that were scored before by the same model.")] = True,
+    hash_mode: Annotated[HashMode, typer.Option("--hash", help="How files are identified in the result and feature caches. fast reads only the start and end of each file")] = HashMode.fast,
+    features: Annotated[bool, typer.Option("--features/--no-features", help="Keep spectrograms on disk so later runs, even with another model, skip decoding.")] = False,
+    decoder: Annotated[Optional[Decoder], typer.Option("--decoder", help="Audio decoder. auto picks soundfile or ffmpeg by file format and falls back to librosa. Defaults to $VIBENET_DECODER or auto")] = None,
+    resample_quality: Annotated[Optional[ResampleQuality], typer.Option("--resample-quality", help="soxr quality for resampling to 16 kHz. QQ is about twice as fast as HQ and moves spectrograms by under 0.3 dB. Defaults to $VIBENET_RESAMPLE_QUALITY or HQ")] = None,
+    decoder_stats: Annotated[bool, typer.Option("--decoder-stats", help="Print how often each decoder succeeded and failed, and the time it took, to stderr.")] = False,
 ):
-    workers = workers or max(1, (os.cpu_count() or 4))
-    
-    net = load_model()
+    # Worker threads each decode and compute spectrograms, and either run the model or hand
+    # it to batch runners that share the CPUs with them
+    budget = plan_budget(workers, cpus=cpus, batch_size=batch_size)
+    workers = budget.workers
     
     paths = _iter_audio_paths(inputs, recursive, glob, quiet, strict)
     
+    from vibenet.decoders import default_decoder
+    from vibenet.resample import default_quality
+    decoder_name = decoder.value if decoder is not None else default_decoder()
+    quality = resample_quality.value if resample_quality is not None else default_quality()
+    
+    results = None
+    if use_daemon:
+        results = daemon.forward(
+            paths, window=window or None, hop=hop or None, precision=precision.value,
+            hash_mode=hash_mode.value if use_cache else None, offset=offset, duration=max_duration or None,
+            decoder=decoder_name, resample_quality=quality, features=features,
+        )
+        
+    forwarded = results is not None
+    if results is None:
+        set_fft_workers(budget.fft_workers)
+        config = SessionConfig(
+            intra_op_threads=intra_op_threads or budget.intra_op_threads,
+            inter_op_threads=inter_op_threads,
+            allow_spinning=spin,
+            cpu_mem_arena=mem_arena,
+            mem_pattern=mem_pattern,
+            execution_mode=execution_mode.value,
+        )
+        results = _predict_local(
+            paths, config, precision.value, workers, decode_processes,
+            batch_size, batch_wait, budget.runners, window or None, hop or None,
+            hash_mode.value if use_cache else None, features, offset, max_duration or None,
+            decoder_name, quality,
+        )
+    
     rows = []
     
-    with ThreadPoolExecutor(max_workers=workers) as ex, Progress(disable=quiet) as progress:
+    with contextlib.closing(results), Progress(disable=quiet) as progress:
         task = progress.add_task("Predicting", total=len(paths))
         
-        futures = {ex.submit(_process_one, p, net): p for p in paths}
-        
-        for fut in as_completed(futures):
-            path = futures[fut]
-            try:
-                row = fut.result()
-                rows.append(row)
-            except Exception as e:
-                if not quiet:
-                    typer.echo(f"Failed on {path}: {e}", err=True)
-                if strict:
-                    for f in futures:
-                        f.cancel()
-                    raise typer.Exit(1)
-            finally:
-                progress.update(task, advance=1)
+        for path, res in results:
+            progress.update(task, advance=1)
+            
+            if isinstance(res, dict):
+                rows.append({"path": str(path), **res})
+                continue
+            
+            if not quiet:
+                typer.echo(f"Failed on {path}: {res}", err=True)
+            if strict:
+                raise typer.Exit(1)
     
     if format == OutputFormat.table:
         table = Table('path', *vibenet.labels)
@@ -106,6 +256,74 @@ def predict(
         writer.writerows(rows)
     elif format == OutputFormat.json:
         sys.stdout.write(json.dumps(rows))
+        
+    if decoder_stats:
+        if forwarded:
+            typer.echo("No decoder stats, the files were decoded by the daemon.", err=True)
+        else:
+            _print_decoder_stats()
+    
+
+def _print_decoder_stats():
+    from vibenet.decoders import decoder_stats
+    
+    table = Table("decoder", "ok", "failed", "total s", "mean ms", title="Decoders")
+    for backend, s in sorted(decoder_stats.snapshot().items()):
+        table.add_row(backend, str(s.successes), str(s.failures), f"{s.seconds:.2f}", f"{1000 * s.seconds / max(1, s.calls):.1f}")
+    Console(stderr=True).print(table)
+    
+
+@app.command()
+def serve(
+    host: Annotated[str, typer.Option("--host", help="Address to bind.")] = "127.0.0.1",
+    port: Annotated[int, typer.Option("--port", help="Port to listen on.")] = 8765,
+    allow_paths: Annotated[bool, typer.Option("--allow-paths", help="Accept server-side file paths as well as uploads.")] = False,
+    batch_size: Annotated[int, typer.Option("--batch-size", "-b", help="Maximum number of concurrent requests scored together.")] = 16,
+    batch_wait: Annotated[float, typer.Option("--batch-wait", help="Milliseconds to wait for a batch to fill.")] = 5,
+    runners: Annotated[int, typer.Option("--runners", help="Number of batches that can run at once.")] = 1,
+    workers: Annotated[int, typer.Option("--workers", "-j", help="Threads decoding files. 0=the CPUs not given to the runners")] = 0,
+    precision: Annotated[Precision, typer.Option("--precision", help="Model weights to use. int8 is faster with a small accuracy cost")] = Precision.fp32,
+    intra_op_threads: Annotated[int, typer.Option("--intra-op-threads", help="ONNX Runtime threads per operator. 0=the runners' share of the CPUs split between them")] = 0,
+):
+    """Serve predictions over HTTP from a warm model."""
+    from vibenet.server import serve as run_server
+    
+    if host not in ("127.0.0.1", "localhost", "::1"):
+        typer.echo(f"Warning: serving on {host}, which may be reachable from other machines", err=True)
+    
+    typer.echo(f"Serving on http://{host}:{port} (POST /predict, GET /health, GET /metrics)", err=True)
+    run_server(
+        host=host,
+        port=port,
+        config=SessionConfig(intra_op_threads=intra_op_threads),
+        precision=precision.value,
+        max_batch_size=batch_size,
+        max_wait=batch_wait / 1000,
+        runners=runners,
+        allow_paths=allow_paths,
+        decode_workers=workers,
+    )
+
+    
+@app.command("daemon")
+def run_daemon(
+    socket_path: Annotated[Optional[Path], typer.Option("--socket", help="Unix socket to listen on. Defaults to $VIBENET_SOCKET, then $XDG_RUNTIME_DIR/vibenet.sock")] = None,
+    workers: Annotated[int, typer.Option("--workers", "-j", help="Decode threads per request. 0=one per CPU")] = 0,
+    precision: Annotated[Precision, typer.Option("--precision", help="Model weights to use. int8 is faster with a small accuracy cost")] = Precision.fp32,
+    intra_op_threads: Annotated[int, typer.Option("--intra-op-threads", help="ONNX Runtime threads per operator. 0=the CPUs left over per decode thread")] = 0,
+    use_cache: Annotated[bool, typer.Option("--cache/--no-cache", help="Reuse results for files that were scored before by the same model.")] = True,
+):
+    """Keep a warm model in the background and answer `vibenet predict` over a Unix socket."""
+    path = socket_path or daemon.default_socket_path()
+    typer.echo(f"Listening on {path}", err=True)
+    
+    budget = plan_budget(workers)
+    set_fft_workers(budget.fft_workers)
+    try:
+        daemon.serve_daemon(path, config=SessionConfig(intra_op_threads=intra_op_threads or budget.intra_op_threads), precision=precision.value, workers=budget.workers, cache=use_cache)
+    except RuntimeError as e:
+        typer.echo(str(e), err=True)
+        raise typer.Exit(1)
     
     
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import os
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+ExecutionMode = Literal["sequential", "parallel"]
+
+
+def default_cache_dir() -> Path:
+    """Per-user cache directory, overridable with the VIBENET_CACHE_DIR environment variable"""
+    if "VIBENET_CACHE_DIR" in os.environ:
+        return Path(os.environ["VIBENET_CACHE_DIR"])
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "vibenet"
+
+
+@dataclass(frozen=True)
+class SessionConfig:
+    """ONNX Runtime session settings
+    
+    The defaults suit running one session per process shared by several worker threads:
+    single-threaded operators and no idle spin-waiting, so workers don't oversubscribe cores.
+    
+    Args:
+        intra_op_threads: Threads used inside a single operator. 0 uses every CPU available to the
+            process, see `vibenet.budget.available_cpus`
+        inter_op_threads: Threads used to run independent operators, only used in parallel mode
+        allow_spinning: Let idle pool threads spin-wait for work instead of sleeping
+        cpu_mem_arena: Reuse CPU allocations through ORT's memory arena
+        mem_pattern: Preplan allocations from the first run of each input shape
+        execution_mode: "sequential" or "parallel" graph execution
+        cache_optimized_model: Save the optimized graph under `default_cache_dir()` on first
+            load and reuse it afterwards, skipping graph optimization at startup
+    """
+    intra_op_threads: int = 1
+    inter_op_threads: int = 1
+    allow_spinning: bool = False
+    cpu_mem_arena: bool = True
+    mem_pattern: bool = True
+    execution_mode: ExecutionMode = "sequential"
+    cache_optimized_model: bool = True
+    
+    def __post_init__(self):
+        if self.execution_mode not in ("sequential", "parallel"):
+            raise ValueError(f"Unknown execution mode: {self.execution_mode}")
+        if self.intra_op_threads < 0 or self.inter_op_threads < 0:
+            raise ValueError("Thread counts must be non-negative.")
@@ -1,24 +1,31 @@
+import asyncio
 import contextlib
 import os
 import sys
-from dataclasses import asdict, dataclass
-from functools import lru_cache
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from os import PathLike
-from typing import Any, BinaryIO, Protocol, Sequence, Union
+from typing import (Any, AsyncIterable, AsyncIterator, BinaryIO, Callable,
+                    Iterable, Iterator, Protocol, Sequence, Union)
 
 import audioread
 import librosa
 import numpy as np
-import soundfile as sf
-import soxr
 from numpy.lib.stride_tricks import sliding_window_view
 from pydub import AudioSegment
 from scipy.fft import rfft
 from scipy.signal import get_window
 
 from vibenet import LIKELIHOODS, labels
+from vibenet.budget import fft_workers
+from vibenet.decoders import decode, default_decoder
+from vibenet.resample import resample
 
 SAMPLE_RATE = 16000 # This is the sample rate used by the backend model
+HOP_LENGTH = 320 # Mel frames are spaced this many samples apart, i.e. 50 frames per second
+
+_CHUNK_FRAMES = 1024 # Frames transformed at once by `extract_mels`
 
 AudioInput = Union[
     str,
@@ -49,9 +56,10 @@ class InferenceResult:
     liveness: float
     speechiness: float
     valence: float
+    embedding: np.ndarray | None = field(default=None, repr=False, compare=False) # Only set on request
     
     @classmethod
-    def from_logits(cls, logits: Sequence[float]) -> "InferenceResult":
+    def from_logits(cls, logits: Sequence[float], embedding: np.ndarray | None = None) -> "InferenceResult":
         values = {}
         
         for i,lbl in enumerate(labels):
@@ -60,17 +68,23 @@ class InferenceResult:
             else:
                 values[lbl] = float(np.clip(logits[i], 0, 1))
                 
-        return cls(**values)
+        return cls(**values, embedding=embedding)
 
     def to_dict(self) -> dict[str, float]:
-        return asdict(self)
+        return {lbl: getattr(self, lbl) for lbl in labels}
 
 
 class Model(Protocol):
     def predict(
         self,
         inputs: AudioInput,
-        sr: int | None = None
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        return_embedding: bool = False,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
     ) -> list[InferenceResult]:
         """Run feature inference on audio
 
@@ -80,39 +94,236 @@ class Model(Protocol):
                 - BinaryIO: open file handle
                 - np.ndarray: raw waveform
             sr: Required if `inputs` are raw waveforms
+            window: If set, score each track in fixed windows of this many seconds and
+                average them, which bounds memory use for long tracks
+            hop: Seconds between window starts. Defaults to `window` (no overlap)
+            return_embedding: Also set each result's `embedding` to the track's 256-d
+                representation from the same forward pass
+            offset: Seconds to skip at the start of each input
+            duration: Only score this many seconds from `offset`. The rest of a file is
+                never decoded
+            max_duration: Upper bound on `duration`, to cap the cost of very long inputs
+        """
+        ...
+        
+    def embed(
+        self,
+        inputs: AudioInput,
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
+    ) -> np.ndarray:
+        """Return the `[N, 256]` embeddings the attribute heads are computed from
+
+        Tracks that sound alike have nearby embeddings (compare them by cosine similarity).
+        Takes the same arguments as `predict`.
+        """
+        ...
+        
+    def predict_iter(
+        self,
+        inputs: Iterable[Any],
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        *,
+        max_in_flight: int = 8,
+        workers: int | None = None,
+        decode_pool: Any = None,
+        return_embedding: bool = False,
+        offset: float = 0.0,
+        duration: float | None = None,
+        max_duration: float | None = None,
+    ) -> Iterator[tuple[Any, InferenceResult | Exception]]:
+        """Stream predictions over a lazy iterable of inputs
+        
+        Yields `(input, result)` pairs as soon as each input is scored, where a failed input's
+        result is its exception. At most `max_in_flight` inputs are read ahead and decoded at a
+        time (on `workers` threads), so memory stays constant however many inputs there are.
+        Pass a `vibenet.decode_pool.DecodePool` to decode files on worker processes instead.
         """
         ...
         
+    async def apredict(
+        self,
+        inputs: AudioInput,
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        *,
+        concurrency: int = 4,
+        chunk_size: int = 8,
+        executor: Executor | None = None,
+        **kwargs,
+    ) -> list[InferenceResult]:
+        """Async version of `predict`, taking the same keyword arguments
+        
+        Inputs are scored `chunk_size` at a time with one `predict` call each in `executor`
+        (the event loop's default executor if None), so they share batches, with at most
+        `concurrency` chunks in flight. The first failure is raised and cancels the chunks that
+        haven't started yet, as does cancelling the awaiting task.
+        """
+        items = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+        results: list[InferenceResult] = [None] * len(items) # type: ignore[list-item]
+        
+        fn = partial(self.predict, sr=sr, window=window, hop=hop, **kwargs)
+        async with contextlib.aclosing(_amap(lambda c: fn([x for _, x in c]), _chunks(enumerate(items), chunk_size), concurrency, executor)) as it:
+            async for chunk, res in it:
+                if isinstance(res, BaseException):
+                    raise res
+                for (i, _), r in zip(chunk, res):
+                    results[i] = r
+        return results
+    
+    async def apredict_iter(
+        self,
+        inputs: Iterable[Any] | AsyncIterable[Any],
+        sr: int | None = None,
+        window: float | None = None,
+        hop: float | None = None,
+        *,
+        concurrency: int = 4,
+        chunk_size: int = 8,
+        executor: Executor | None = None,
+        **kwargs,
+    ) -> AsyncIterator[tuple[Any, InferenceResult | Exception]]:
+        """Yield `(input, result)` pairs as chunks complete, where a failed input's result is its exception
+        
+        `inputs` is consumed lazily, `chunk_size` at a time, and each chunk is scored with one
+        `predict_iter` call (taking the same keyword arguments) in `executor`. No more than
+        `concurrency` chunks are in flight, so a slow consumer applies back-pressure to the
+        producer. Closing the iterator or cancelling its task cancels the chunks that haven't
+        started yet.
+        """
+        fn = partial(self._predict_chunk, sr=sr, window=window, hop=hop, **kwargs)
+        async with contextlib.aclosing(_amap(fn, _chunks(inputs, chunk_size), concurrency, executor)) as it:
+            async for chunk, pairs in it:
+                if isinstance(pairs, BaseException):
+                    pairs = [(item, pairs) for item in chunk]
+                for pair in pairs:
+                    yield pair
+        
+    def _predict_chunk(self, chunk: list[Any], **kwargs) -> list[tuple[Any, InferenceResult | Exception]]:
+        kwargs.setdefault("max_in_flight", len(chunk))
+        return list(self.predict_iter(chunk, **kwargs))
+        
+
+async def _chunks(inputs: Iterable[Any] | AsyncIterable[Any], size: int) -> AsyncIterator[list[Any]]:
+    """Group `inputs` into lists of up to `size` items, reading them lazily"""
+    chunk: list[Any] = []
+    if isinstance(inputs, AsyncIterable):
+        async for item in inputs:
+            chunk.append(item)
+            if len(chunk) >= max(1, size):
+                yield chunk
+                chunk = []
+    else:
+        for item in inputs:
+            chunk.append(item)
+            if len(chunk) >= max(1, size):
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
 
-def load_audio(path, target_sr=16000):
+
+async def _amap(
+    fn: Callable[[Any], Any],
+    inputs: AsyncIterable[Any],
+    concurrency: int,
+    executor: Executor | None,
+) -> AsyncIterator[tuple[Any, Any]]:
+    """Run `fn` over `inputs` in an executor with bounded concurrency, yielding `(input, result | exception)`"""
+    loop = asyncio.get_running_loop()
+    
+    async def run(item):
+        try:
+            return item, await loop.run_in_executor(executor, fn, item)
+        except Exception as e:
+            return item, e
+    
+    tasks: list[asyncio.Task] = []
+    
+    async def finished() -> list[tuple[Any, Any]]:
+        nonlocal tasks
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        tasks = [t for t in tasks if t not in done]
+        return [t.result() for t in done]
+    
     try:
-        y, sr = sf.read(path, always_2d=False)
-    except Exception:
-        y, sr = librosa.load(path, sr=target_sr, mono=False)
-    y = np.asarray(y, dtype=np.float32)
-    if y.ndim == 2:
-        y = y.mean(axis=1)
-    if sr != target_sr:
-        y = soxr.resample(y, sr, target_sr)
-    return y
-    
-
-def create_batch(inputs, sr: int | None):
+        async for item in inputs:
+            while len(tasks) >= max(1, concurrency):
+                for pair in await finished():
+                    yield pair
+            tasks.append(asyncio.ensure_future(run(item)))
+            
+        while tasks:
+            for pair in await finished():
+                yield pair
+    finally:
+        for t in tasks:
+            t.cancel()
+        
+
+
+def clip_duration(duration: float | None, max_duration: float | None) -> float | None:
+    """The shorter of two optional durations"""
+    if duration is None:
+        return max_duration
+    if max_duration is None:
+        return duration
+    return min(duration, max_duration)
+
+
+def load_audio(
+    path,
+    target_sr=16000,
+    decoder: str | None = None,
+    offset: float = 0.0,
+    duration: float | None = None,
+    max_duration: float | None = None,
+):
+    """Decode `path` (or an open file) to a mono float32 waveform at `target_sr`
+    
+    `decoder` is one of `vibenet.decoders.DECODERS`, defaulting to `$VIBENET_DECODER` or
+    "auto". "auto" picks a backend from the file's format, see `vibenet.decoders.decoder_plan`.
+    Attempts are counted in `vibenet.decoders.decoder_stats`.
+    
+    Only the `duration` seconds starting at `offset` are decoded, capped at `max_duration`.
+    Decoders seek to `offset` rather than decoding up to it.
+    """
+    return decode(path, target_sr, decoder or default_decoder(), offset, clip_duration(duration, max_duration))
+    
+
+def create_batch(
+    inputs,
+    sr: int | None,
+    offset: float = 0.0,
+    duration: float | None = None,
+    max_duration: float | None = None,
+):
     if not isinstance(inputs, (list, tuple)):
         inputs = [inputs]
         
+    duration = clip_duration(duration, max_duration)
     out = []
     
     for item in inputs:
         if isinstance(item, np.ndarray):
             if sr is None:
                 raise ValueError("When passing raw waveforms, their sample rate (sr) must be provided.")
+            if offset or duration is not None:
+                start = int(offset * sr)
+                item = item[start:start + int(duration * sr)] if duration is not None else item[start:]
             if sr != SAMPLE_RATE:
-                item = soxr.resample(item, sr, SAMPLE_RATE)
+                item = resample(item, sr, SAMPLE_RATE)
                 
             out.append(item)
         else:
-            waveform = load_audio(item)
+            waveform = load_audio(item, offset=offset, duration=duration)
             out.append(waveform)
     
     return out
@@ -128,7 +339,7 @@ def _cached_mel(sr: int, n_fft: int, n_mels: int, fmin: float, fmax: float) -> n
     return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax).astype(np.float32)
 
 
-def _power_to_db_fast(S: np.ndarray, top_db: float = 80.0, amin: float = 1e-10, ref: float = 1.0) -> np.ndarray:
+def _power_to_db_fast(S: np.ndarray, top_db: float | None = 80.0, amin: float = 1e-10, ref: float = 1.0) -> np.ndarray:
     S_db = 10.0 * np.log10(np.maximum(amin, S)) - 10.0 * np.log10(np.maximum(amin, ref))
     if top_db is not None:
         S_db = np.maximum(S_db, S_db.max() - top_db)
@@ -139,7 +350,7 @@ def extract_mel(
     y: np.ndarray,
     sr: int,
     n_fft: int = 1024,
-    hop_length: int = 320,
+    hop_length: int = HOP_LENGTH,
     win_length: int = 640,
     n_mels: int = 128,
     fmin: float = 0.0,
@@ -158,7 +369,7 @@ def extract_mel(
     window = _cached_window(win_length, window_type)
     frames = frames * window[None, :]
 
-    spec = rfft(frames, n=n_fft, axis=-1, workers=-1)
+    spec = rfft(frames, n=n_fft, axis=-1, workers=fft_workers())
     S_pow = (spec.real**2 + spec.imag**2).astype(np.float32) # type: ignore[index]
 
     mel_fb = _cached_mel(sr, n_fft, n_mels, fmin, fmax)
@@ -166,4 +377,196 @@ def extract_mel(
     mel = mel.astype(np.float32)
 
     mel_db = _power_to_db_fast(mel, top_db=80.0, ref=1.0)
-    return mel_db
\ No newline at end of file
+    return mel_db
+
+
+def extract_mels(
+    waveforms: Sequence[np.ndarray] | np.ndarray,
+    sr: int,
+    lengths: Sequence[int] | np.ndarray | None = None,
+    n_fft: int = 1024,
+    hop_length: int = HOP_LENGTH,
+    win_length: int = 640,
+    n_mels: int = 128,
+    fmin: float = 0.0,
+    fmax: float = 8000.0,
+    window_type: str = "hann",
+    center: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """`extract_mel` for many waveforms at once
+    
+    `waveforms` is a list of 1-D arrays, or a `[N, samples]` array whose rows are valid up to
+    `lengths`. Frames from all tracks share each rfft and mel matmul, instead of paying for
+    separate calls per short clip. Returns `[N, n_mels, T]` mels, each padded with its own
+    lowest value, and the number of valid frames of each. The mels match `extract_mel`
+    exactly, except for tracks under a second or so, which may differ by rounding (~1e-5 dB).
+    """
+    if isinstance(waveforms, np.ndarray) and waveforms.ndim == 2:
+        lengths = [waveforms.shape[1]] * len(waveforms) if lengths is None else lengths
+        waveforms = [y[:n] for y, n in zip(waveforms, lengths)]
+    if not len(waveforms):
+        return np.zeros((0, n_mels, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+    
+    tracks = []
+    for y in waveforms:
+        if center:
+            pad = (win_length // 2)
+            y = np.pad(y, (pad, pad), mode="reflect")
+        if y.shape[0] < win_length:
+            y = np.pad(y, (0, win_length - y.shape[0]))
+        tracks.append(sliding_window_view(y, win_length)[::hop_length])
+        
+    window = _cached_window(win_length, window_type)
+    mel_fb = _cached_mel(sr, n_fft, n_mels, fmin, fmax)
+    n_frames = np.array([len(f) for f in tracks])
+    bounds = np.concatenate([[0], np.cumsum(n_frames)])
+    
+    # Frames of all tracks are transformed together in cache-sized chunks. Rows are zero-padded
+    # to n_fft up front, so rfft doesn't copy each chunk to pad it.
+    total = bounds[-1]
+    buf = np.zeros((min(_CHUNK_FRAMES, total), max(n_fft, win_length)), dtype=np.result_type(*tracks, window))
+    mel_db = np.empty((n_mels, total), dtype=np.float32)
+    for a in range(0, total, _CHUNK_FRAMES):
+        b = min(a + _CHUNK_FRAMES, total)
+        start = max(0, b - _CHUNK_FRAMES) # A short last chunk is extended backwards, see MelStream.finish
+        
+        row, i = start, int(np.searchsorted(bounds, start, side="right")) - 1
+        while row < b:
+            lo, hi = row - bounds[i], min(b, bounds[i + 1]) - bounds[i]
+            np.multiply(tracks[i][lo:hi], window[None, :], out=buf[row - start:row - start + hi - lo, :win_length])
+            row += hi - lo
+            i += 1
+        
+        spec = rfft(buf[:b - start], n=n_fft, axis=-1, workers=fft_workers())
+        S_pow = (spec.real**2 + spec.imag**2).astype(np.float32, copy=False) # type: ignore[index]
+        mel = (mel_fb @ S_pow.T).astype(np.float32, copy=False)
+        mel_db[:, a:b] = _power_to_db_fast(mel[:, a - start:], top_db=None)
+    
+    out = np.empty((len(tracks), n_mels, n_frames.max()), dtype=np.float32)
+    for i, (a, b) in enumerate(zip(bounds, bounds[1:])):
+        m = mel_db[:, a:b]
+        m = np.maximum(m, m.max() - 80.0) # top_db per track, as in extract_mel
+        out[i, :, :b - a] = m
+        out[i, :, b - a:] = m.min()
+    return out, n_frames
+
+
+class MelStream:
+    """Compute `extract_mel` incrementally from consecutive blocks of a float32 waveform
+
+    `push` blocks as they are decoded and call `finish` for the `[n_mels, T]` spectrogram,
+    which is bit-identical to `extract_mel` on the whole waveform. Only a frame's overlap of
+    samples and the dB frames computed so far are kept, so the STFT temporaries stay the size
+    of `block_frames` frames. The `top_db` floor depends on the loudest frame, so it is
+    tracked as a running max and applied in `finish`.
+    """
+    def __init__(
+        self,
+        sr: int,
+        n_fft: int = 1024,
+        hop_length: int = HOP_LENGTH,
+        win_length: int = 640,
+        n_mels: int = 128,
+        fmin: float = 0.0,
+        fmax: float = 8000.0,
+        window_type: str = "hann",
+        center: bool = False,
+        block_frames: int = 1024,
+    ):
+        self.sr, self.n_fft, self.hop_length, self.win_length = sr, n_fft, hop_length, win_length
+        self.n_mels, self.fmin, self.fmax, self.window_type, self.center = n_mels, fmin, fmax, window_type, center
+        self.block_frames = block_frames
+        
+        self._pad = win_length // 2 if center else 0
+        self._raw: list[np.ndarray] = [] # Samples held back until there are enough to stream
+        self._n_raw = 0
+        self._buf: np.ndarray | None = None # Samples from the start of the next frame on
+        self._tail = np.zeros(0, dtype=np.float32) # The last samples, to reflect at the end
+        self._last_pow: np.ndarray | None = None
+        self._max: np.float32 | None = None
+        self._blocks: list[np.ndarray] = []
+        
+    def push(self, y: np.ndarray):
+        y = np.asarray(y, dtype=np.float32)
+        if self.center:
+            self._tail = np.concatenate([self._tail, y])[-(self._pad + 1):]
+        
+        if self._buf is None:
+            # Shorter waveforms need padding or reflecting in ways that `finish` leaves to extract_mel
+            self._raw.append(y.copy())
+            self._n_raw += len(y)
+            if self._n_raw < max(self.win_length, self._pad + 1):
+                return
+            y = np.concatenate(self._raw)
+            self._raw = []
+            self._buf = np.concatenate([y[self._pad:0:-1], y]) if self.center else y
+        else:
+            self._buf = np.concatenate([self._buf, y])
+        
+        n = self.block_frames
+        while len(self._buf) >= self.win_length + (n - 1) * self.hop_length:
+            self._last_pow = self._power(self._buf, n)
+            self._add(self._last_pow)
+            self._buf = self._buf[n * self.hop_length:]
+        
+    def finish(self, top_db: float = 80.0) -> np.ndarray:
+        if self._buf is None:
+            return extract_mel(
+                np.concatenate(self._raw) if self._raw else np.zeros(0, dtype=np.float32), self.sr,
+                self.n_fft, self.hop_length, self.win_length, self.n_mels, self.fmin, self.fmax,
+                self.window_type, self.center,
+            )
+        
+        buf = np.concatenate([self._buf, self._tail[-2::-1]]) if self.center else self._buf
+        if len(buf) >= self.win_length:
+            S_pow = self._power(buf, (len(buf) - self.win_length) // self.hop_length + 1)
+            n = len(S_pow)
+            if self._last_pow is not None:
+                # The mel matmul of a handful of frames may round differently from a long one,
+                # so the last frames are computed along with enough earlier ones to match
+                S_pow = np.concatenate([self._last_pow, S_pow])[-self.block_frames:]
+            self._add(S_pow, keep=n)
+        
+        mel_db = np.concatenate(self._blocks, axis=1)
+        self._blocks = []
+        if top_db is not None:
+            np.maximum(mel_db, self._max - top_db, out=mel_db)
+        return mel_db
+    
+    def _power(self, y: np.ndarray, n_frames: int) -> np.ndarray:
+        frames = sliding_window_view(y[:self.win_length + (n_frames - 1) * self.hop_length], self.win_length)[::self.hop_length]
+        frames = frames * _cached_window(self.win_length, self.window_type)[None, :]
+        spec = rfft(frames, n=self.n_fft, axis=-1, workers=fft_workers())
+        return (spec.real**2 + spec.imag**2).astype(np.float32) # type: ignore[index]
+    
+    def _add(self, S_pow: np.ndarray, keep: int | None = None):
+        mel_fb = _cached_mel(self.sr, self.n_fft, self.n_mels, self.fmin, self.fmax)
+        mel = (mel_fb @ S_pow.T).astype(np.float32)
+        if keep is not None:
+            mel = mel[:, len(S_pow) - keep:]
+        mel_db = _power_to_db_fast(mel, top_db=None)
+        self._max = mel_db.max() if self._max is None else max(self._max, mel_db.max())
+        self._blocks.append(mel_db)
+
+
+def extract_mel_blocks(blocks: Iterable[np.ndarray], sr: int, **kwargs) -> np.ndarray:
+    """`extract_mel` over a waveform given as consecutive blocks, see `MelStream`"""
+    stream = MelStream(sr, **kwargs)
+    for y in blocks:
+        stream.push(y)
+    return stream.finish()
+
+
+def window_starts(n_frames: int, size: int, hop: int) -> list[int]:
+    """Start frames of `size`-frame windows spaced `hop` apart over `n_frames` frames.
+    
+    The last window is aligned to the end so that every frame is covered and no window
+    needs padding. Inputs no longer than `size` are a single window starting at 0.
+    """
+    if n_frames <= size:
+        return [0]
+    
+    starts = list(range(0, n_frames - size + 1, hop))
+    if starts[-1] != n_frames - size:
+        starts.append(n_frames - size)
+    return starts
@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import socketserver
+from pathlib import Path
+from typing import Any, Iterator
+
+from vibenet.config import SessionConfig, default_cache_dir
+
+# This module is imported by every `vibenet predict` to look for a running daemon, so it must
+# not import librosa or onnxruntime at module level.
+
+CONNECT_TIMEOUT = 0.5
+
+
+def default_socket_path() -> Path:
+    if "VIBENET_SOCKET" in os.environ:
+        return Path(os.environ["VIBENET_SOCKET"])
+    if "XDG_RUNTIME_DIR" in os.environ:
+        return Path(os.environ["XDG_RUNTIME_DIR"]) / "vibenet.sock"
+    return default_cache_dir() / "daemon.sock"
+
+
+def forward(
+    paths: list[Path],
+    window: float | None = None,
+    hop: float | None = None,
+    precision: str = "fp32",
+    socket_path: Path | None = None,
+    hash_mode: str | None = None,
+    offset: float = 0.0,
+    duration: float | None = None,
+    decoder: str = "auto",
+    resample_quality: str = "HQ",
+    features: bool = False,
+) -> Iterator[tuple[str, dict[str, Any] | str]] | None:
+    """Send `paths` to a running daemon, or return None if there isn't one that can take them
+
+    Returns an iterator of `(path, scores)` pairs in completion order, where `scores` is the
+    error message instead if that path failed. With a `hash_mode`, the daemon answers from its
+    result cache where it can. A daemon whose precision, decoder, resampling quality or
+    feature store differ from the ones asked for declines, since its results would too.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+
+    # The daemon has its own working directory, so send absolute paths and map them back
+    originals = {str(Path(p).resolve()): str(p) for p in paths}
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(str(socket_path or default_socket_path()))
+        sock.settimeout(None)
+
+        request = {
+            "paths": list(originals),
+            "window": window,
+            "hop": hop,
+            "precision": precision,
+            "hash": hash_mode,
+            "offset": offset,
+            "duration": duration,
+            "decoder": decoder,
+            "resample_quality": resample_quality,
+            "features": features,
+        }
+        sock.sendall(json.dumps(request).encode() + b"\n")
+
+        stream = sock.makefile("rb")
+        hello = json.loads(stream.readline() or b"{}")
+    except (OSError, ValueError):
+        sock.close()
+        return None
+
+    if not hello.get("ok"):
+        sock.close()
+        return None
+
+    def results():
+        try:
+            for line in stream:
+                msg = json.loads(line)
+                if msg.get("done"):
+                    return
+                path = msg.pop("path")
+                yield originals.get(path, path), msg.get("error", msg)
+        finally:
+            stream.close()
+            sock.close()
+
+    return results()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "DaemonServer"
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return # Liveness probe, or a client that gave up
+        
+        try:
+            request = json.loads(line)
+            paths = request["paths"]
+        except (ValueError, KeyError, TypeError):
+            self._send({"error": "malformed request"})
+            return
+
+        for key, value in self.server.settings.items():
+            if request.get(key, value) != value:
+                self._send({"error": f"daemon runs with {key}={value}"})
+                return
+        self._send({"ok": True})
+
+        model = self.server.caches.get(request.get("hash"), self.server.model)
+        results = model.predict_iter(
+            paths, window=request.get("window"), hop=request.get("hop"),
+            offset=request.get("offset") or 0.0, duration=request.get("duration"),
+            max_in_flight=self.server.workers * 2, workers=self.server.workers,
+        )
+        try:
+            for path, res in results:
+                if isinstance(res, Exception):
+                    self._send({"path": path, "error": str(res)})
+                else:
+                    self._send({"path": path, **res.to_dict()})
+            self._send({"done": True})
+        except (BrokenPipeError, ConnectionResetError):
+            results.close() # Client went away, stop decoding the rest
+
+    def _send(self, msg: dict):
+        self.wfile.write(json.dumps(msg).encode() + b"\n")
+        self.wfile.flush()
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class DaemonServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path: Path, model, precision: str, workers: int, cache: bool = True):
+            from vibenet.decoders import default_decoder
+            from vibenet.resample import default_quality
+
+            self.model = model
+            self.precision = precision
+            self.workers = workers
+            # Requests asking for anything else are declined, see `forward`
+            self.settings = {
+                "precision": precision,
+                "decoder": default_decoder(),
+                "resample_quality": default_quality(),
+                "features": False,
+            }
+            self.caches = {}
+            if cache:
+                from vibenet.cache import CachedModel, ResultCache
+                self.caches = {mode: CachedModel(model, ResultCache(hash_mode=mode)) for mode in ("fast", "full")}
+            super().__init__(str(socket_path), _Handler)
+
+
+def serve_daemon(
+    socket_path: Path | None = None,
+    config: SessionConfig | None = None,
+    precision: str = "fp32",
+    workers: int | None = None,
+    cache: bool = True,
+):
+    """Keep a warm model and answer `vibenet predict` requests on a Unix socket until interrupted"""
+    if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+        raise RuntimeError("The vibenet daemon needs Unix domain sockets, which this platform lacks.")
+
+    from vibenet.budget import available_cpus
+    from vibenet.registry import default_registry
+
+    socket_path = socket_path or default_socket_path()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Take over a stale socket left by a daemon that didn't shut down cleanly, but not a live one
+    if socket_path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(socket_path))
+        except OSError:
+            socket_path.unlink()
+        else:
+            raise RuntimeError(f"A daemon is already listening on {socket_path}")
+        finally:
+            probe.close()
+
+    model = default_registry.warmup(config, precision)
+    
+    # Only our user may have the daemon read files on its behalf
+    old_umask = os.umask(0o177)
+    try:
+        server = DaemonServer(socket_path, model, precision, workers or available_cpus(), cache)
+    finally:
+        os.umask(old_umask)
+        
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from vibenet.budget import available_cpus
+from vibenet.core import SAMPLE_RATE, load_audio
+from vibenet.decoders import decoder_stats, default_decoder
+from vibenet.resample import default_quality
+
+# POSIX shared memory can be unlinked as soon as the parent maps it. On Windows a segment
+# disappears once its creator closes it, so waveforms are pickled back instead.
+_USE_SHM = os.name != "nt"
+
+
+def _init_worker(decoder: str, resample_quality: str):
+    # Workers belong to the pool, so their process-wide defaults can be set for good
+    os.environ["VIBENET_DECODER"] = decoder
+    os.environ["VIBENET_RESAMPLE_QUALITY"] = resample_quality
+
+
+def _decode(path, target_sr: int, offset: float = 0.0, duration: float | None = None):
+    # Decoder counters go back with every result, failures included, for the parent to merge
+    try:
+        return _decode_shared(path, target_sr, offset, duration), decoder_stats.take()
+    except Exception as e:
+        return e, decoder_stats.take()
+
+
+def _decode_shared(path, target_sr: int, offset: float, duration: float | None):
+    wf = np.ascontiguousarray(load_audio(path, target_sr, offset=offset, duration=duration), dtype=np.float32)
+    if not _USE_SHM:
+        return wf
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, wf.nbytes))
+    try:
+        np.ndarray(wf.shape, dtype=np.float32, buffer=shm.buf)[:] = wf
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, wf.shape[0]
+
+
+class SharedWaveform:
+    """A decoded waveform handed back by a `DecodePool` worker
+
+    `array` is a zero-copy view of the worker's shared-memory segment and is only valid
+    until `close()`, so don't keep references to it past that point.
+    """
+    def __init__(self, result):
+        if isinstance(result, np.ndarray):
+            self._shm = None
+            self.array = result
+            return
+
+        name, length = result
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._shm.unlink() # The mapping stays valid, and the memory is freed on close
+        self.array = np.ndarray((length,), dtype=np.float32, buffer=self._shm.buf)
+
+    def close(self):
+        self.array = None # type: ignore[assignment]
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                pass # Something still views the buffer, the mapping is freed along with it
+            self._shm = None
+
+    def __enter__(self) -> "SharedWaveform":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DecodePool:
+    """Decode audio files on worker processes instead of threads
+
+    Decoding falls back to GIL-bound Python code for many formats, so a thread pool stops
+    scaling after a few cores. Workers here decode and resample to `target_sr`, then write
+    the float32 waveform into a shared-memory segment that the parent maps without copying.
+
+    Workers decode with `decoder` and `resample_quality`, defaulting to the caller's
+    `default_decoder()` and `default_quality()` when the pool is created.
+    """
+    def __init__(
+        self,
+        processes: int | None = None,
+        target_sr: int = SAMPLE_RATE,
+        decoder: str | None = None,
+        resample_quality: str | None = None,
+    ):
+        self.target_sr = target_sr
+        self.decoder = decoder or default_decoder()
+        self.resample_quality = resample_quality or default_quality()
+
+        # Forking a process that already runs ORT or decoder threads is unsafe
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes or available_cpus(),
+            mp_context=multiprocessing.get_context(method),
+            initializer=_init_worker,
+            initargs=(self.decoder, self.resample_quality),
+        )
+
+    def submit(self, path, offset: float = 0.0, duration: float | None = None) -> "Future[tuple[str, int] | np.ndarray]":
+        fut: Future = Future()
+
+        def done(inner: Future):
+            try:
+                result, stats = inner.result()
+            except BaseException as e: # The worker died, or the call was cancelled
+                fut.set_exception(e)
+                return
+            decoder_stats.merge(stats)
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+        inner = self._executor.submit(_decode, path, self.target_sr, offset, duration)
+        inner.add_done_callback(done)
+        return fut
+
+    def load(self, path, offset: float = 0.0, duration: float | None = None) -> SharedWaveform:
+        return SharedWaveform(self.submit(path, offset, duration).result())
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> "DecodePool":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
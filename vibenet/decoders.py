@@ -0,0 +1,447 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from os import PathLike
+from typing import Callable, Iterator
+
+import numpy as np
+import soundfile as sf
+
+from vibenet.pcm import iter_pcm, pcm_layout, read_pcm
+from vibenet.resample import default_quality, resample, stream
+
+DECODERS = ("auto", "soundfile", "ffmpeg", "librosa")
+
+# Container formats recognized by `sniff_format`, by file extension
+EXTENSIONS = {
+    ".wav": "wav", ".wave": "wav", ".aif": "aiff", ".aiff": "aiff", ".aifc": "aiff",
+    ".flac": "flac", ".ogg": "ogg", ".oga": "ogg", ".opus": "ogg", ".caf": "caf",
+    ".mp3": "mp3", ".m4a": "mp4", ".m4b": "mp4", ".mp4": "mp4", ".alac": "mp4",
+    ".aac": "aac", ".wma": "asf", ".wv": "wavpack", ".ape": "ape", ".mka": "matroska",
+    ".webm": "matroska",
+}
+
+# Formats libsndfile decodes natively. MP3 is added at runtime when it was built with mpg123.
+_SOUNDFILE_FORMATS = {"wav", "aiff", "flac", "ogg", "caf"}
+
+_INITIAL_SECONDS = 240 # Decode buffers start this long and double as needed
+_BLOCK_FRAMES = 64 * 1024 # Frames per libsndfile read
+
+_scratch = threading.local()
+
+
+def default_decoder() -> str:
+    """The decoder `load_audio` uses when none is given, from `$VIBENET_DECODER` (default "auto")
+
+    See `decode_settings` to change it for a block of code.
+    """
+    decoder = os.environ.get("VIBENET_DECODER", "auto")
+    if decoder not in DECODERS:
+        raise ValueError(f"Unknown decoder {decoder!r} in $VIBENET_DECODER, expected one of {list(DECODERS)}")
+    return decoder
+
+
+@contextmanager
+def decode_settings(decoder: str | None = None, resample_quality: str | None = None) -> Iterator[None]:
+    """Make `decoder` and `resample_quality` the defaults until the block exits
+
+    They stand in for `$VIBENET_DECODER` and `$VIBENET_RESAMPLE_QUALITY`, which are restored
+    afterwards, so the settings are process-wide only while the block runs. None leaves a
+    setting as it is. A `DecodePool` created inside the block passes them on to its workers.
+    """
+    saved: dict[str, str | None] = {}
+    try:
+        for var, value in (("VIBENET_DECODER", decoder), ("VIBENET_RESAMPLE_QUALITY", resample_quality)):
+            if value is not None:
+                saved[var] = os.environ.get(var)
+                os.environ[var] = value
+        default_decoder(), default_quality() # Fail here on an unknown value
+        yield
+    finally:
+        for var, old in saved.items():
+            if old is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = old
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_path() -> str | None:
+    return shutil.which("ffmpeg")
+
+
+def is_path(source) -> bool:
+    return isinstance(source, (str, bytes, PathLike))
+
+
+def _sniff_magic(header: bytes) -> str | None:
+    if header[:4] in (b"RIFF", b"RF64") and header[8:12] == b"WAVE":
+        return "wav"
+    if header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    for magic, fmt in ((b"fLaC", "flac"), (b"OggS", "ogg"), (b"caff", "caf"), (b"ID3", "mp3"),
+                       (b"wvpk", "wavpack"), (b"MAC ", "ape"), (b"\x30\x26\xb2\x75", "asf"),
+                       (b"\x1a\x45\xdf\xa3", "matroska")):
+        if header.startswith(magic):
+            return fmt
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        return "aac" if header[1] & 0x06 == 0 else "mp3" # MPEG audio frame sync, ADTS has layer 0
+    return None
+
+
+def sniff_format(source) -> str | None:
+    """Guess the container format of a file path or open binary file
+
+    Looks at the first bytes first and falls back to the extension, returning a value of
+    `EXTENSIONS` or None. Open files are rewound afterwards.
+    """
+    header = b""
+    try:
+        if is_path(source):
+            with open(source, "rb") as f:
+                header = f.read(12)
+        elif hasattr(source, "read") and hasattr(source, "seek"):
+            pos = source.tell()
+            header = source.read(12)
+            source.seek(pos)
+    except (OSError, ValueError):
+        pass # Let the decoder report the error
+
+    fmt = _sniff_magic(header) if isinstance(header, bytes) else None
+    if fmt is None and is_path(source):
+        fmt = EXTENSIONS.get(os.path.splitext(os.fsdecode(source))[1].lower())
+    return fmt
+
+
+@lru_cache(maxsize=1)
+def _soundfile_formats() -> frozenset[str]:
+    return frozenset(_SOUNDFILE_FORMATS | ({"mp3"} if "MP3" in sf.available_formats() else set()))
+
+
+def decoder_plan(source, decoder: str = "auto") -> list[str]:
+    """The backends `decode` tries for `source`, in order
+
+    "auto" goes straight to the fastest backend that handles the sniffed format: libsndfile
+    in-process for the formats it reads, else ffmpeg if it is on PATH. The others are only
+    tried if that one fails. Any other `decoder` is used on its own, except that ffmpeg
+    needs a path and leaves open files to "auto".
+    """
+    if decoder not in DECODERS:
+        raise ValueError(f"Unknown decoder {decoder!r}, expected one of {list(DECODERS)}")
+    path = is_path(source)
+    if decoder != "auto" and (decoder != "ffmpeg" or path):
+        return [decoder]
+
+    fmt = sniff_format(source)
+    ffmpeg = ["ffmpeg"] if path and ffmpeg_path() is not None else []
+    if fmt is None or fmt in _soundfile_formats():
+        return ["soundfile", *ffmpeg, "librosa"]
+    return [*ffmpeg, "librosa"]
+
+
+def decoder_key(source) -> str:
+    """The backend `decode` tries first for `source` under `default_decoder()`, or "" for libsndfile
+
+    Backends decode and resample differently, so caches of waveform-derived data keep their
+    outputs apart with this. libsndfile, the usual backend, leaves keys unchanged.
+    """
+    backend = decoder_plan(source, default_decoder())[0]
+    return "" if backend == "soundfile" else backend
+
+
+def decode_ffmpeg(path: str | bytes | PathLike, target_sr: int, offset: float = 0.0, duration: float | None = None) -> np.ndarray:
+    """Decode the first audio stream of `path` to mono float32 at `target_sr` with ffmpeg
+
+    ffmpeg downmixes and resamples itself and writes raw samples to a pipe, which are read
+    straight into a preallocated buffer. With `offset`, ffmpeg seeks in the input instead of
+    decoding up to it.
+    """
+    ffmpeg = ffmpeg_path()
+    if ffmpeg is None:
+        raise RuntimeError("The ffmpeg decoder needs ffmpeg on PATH")
+
+    cmd = [
+        ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+        *(["-ss", f"{offset:.6f}"] if offset else []),
+        "-i", os.fsdecode(path),
+        *(["-t", f"{duration:.6f}"] if duration is not None else []),
+        "-map", "0:a:0",
+        # Normalizing the downmix makes stereo the channel mean, like the other decoders,
+        # rather than ffmpeg's default of (L + R) / sqrt(2)
+        "-af", f"aresample={target_sr}:out_chlayout=mono:out_sample_fmt=flt:rematrix_maxval=1",
+        "-f", "f32le", "-acodec", "pcm_f32le", "pipe:1",
+    ]
+
+    # A file for stderr can't fill up and stall ffmpeg while we only read stdout
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err, stdin=subprocess.DEVNULL)
+        assert proc.stdout is not None
+
+        seconds = duration + 1 if duration is not None else _INITIAL_SECONDS
+        buf = np.empty(max(1, int(seconds * target_sr)), dtype=np.float32)
+        filled = 0 # Bytes
+        with proc.stdout:
+            while True:
+                view = memoryview(buf).cast("B")
+                if filled == len(view):
+                    buf = np.resize(buf, 2 * len(buf))
+                    continue
+                n = proc.stdout.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+
+        if proc.wait() != 0:
+            err.seek(0)
+            msg = err.read().decode(errors="replace").strip().splitlines()
+            raise RuntimeError(f"ffmpeg could not decode {os.fsdecode(path)}: {msg[-1] if msg else f'exit status {proc.returncode}'}")
+
+    n = filled // 4
+    # Don't hold on to a mostly empty buffer
+    return buf[:n] if n > len(buf) // 2 else buf[:n].copy()
+
+
+def _block_buffer(channels: int) -> np.ndarray:
+    """Per-thread scratch buffer for one block of interleaved samples"""
+    buf = getattr(_scratch, "block", None)
+    if buf is None or buf.shape[1] != channels:
+        buf = _scratch.block = np.empty((_BLOCK_FRAMES, channels), dtype=np.float32)
+    return buf
+
+
+def _soundfile_blocks(f: sf.SoundFile, offset: float, duration: float | None) -> Iterator[np.ndarray]:
+    """Yield mono float32 blocks of an open file at its own rate, reusing the same buffers"""
+    start = int(offset * f.samplerate)
+    if start:
+        if start >= f.frames > 0:
+            return
+        f.seek(start)
+
+    frames = int(duration * f.samplerate) if duration is not None else -1
+    mono = np.empty(_BLOCK_FRAMES, dtype=np.float32)
+    block = _block_buffer(f.channels) if f.channels > 1 else None
+    filled = 0
+    while frames < 0 or filled < frames:
+        want = _BLOCK_FRAMES if frames < 0 else min(_BLOCK_FRAMES, frames - filled)
+        if block is None:
+            got = len(f.read(dtype="float32", out=mono[:want]))
+        else:
+            got = len(chunk := f.read(dtype="float32", out=block[:want]))
+            np.mean(chunk, axis=1, out=mono[:got])
+        if got:
+            yield mono[:got]
+        filled += got
+        if got < want:
+            break
+
+
+def _read_soundfile(source, offset: float, duration: float | None) -> tuple[np.ndarray, int]:
+    """Read `source` with libsndfile as mono float32
+
+    Samples are read as float32 in blocks, and multichannel blocks are averaged as they are
+    read, so the only full-length buffer is the mono waveform itself.
+    """
+    with sf.SoundFile(source) as f:
+        start = int(offset * f.samplerate)
+        frames = int(duration * f.samplerate) if duration is not None else -1
+        known = max(0, f.frames - start) if f.frames > 0 else -1 # Unknown for some streams
+        expected = min(frames, known) if frames >= 0 and known >= 0 else max(frames, known)
+        mono = np.empty(expected if expected >= 0 else _INITIAL_SECONDS * f.samplerate, dtype=np.float32)
+
+        filled = 0
+        for y in _soundfile_blocks(f, offset, duration):
+            if filled + len(y) > len(mono):
+                mono = np.resize(mono, max(2 * len(mono), filled + len(y)))
+            mono[filled:filled + len(y)] = y
+            filled += len(y)
+
+    # Don't hold on to a mostly empty buffer
+    return (mono[:filled] if filled > len(mono) // 2 else mono[:filled].copy()), f.samplerate
+
+
+def _to_mono(y: np.ndarray, sr: int, target_sr: int) -> np.ndarray:
+    y = np.asarray(y, dtype=np.float32)
+    if y.ndim == 2:
+        y = y.mean(axis=1)
+    if sr != target_sr:
+        y = resample(y, sr, target_sr)
+    return y
+
+
+def decode_soundfile(source, target_sr: int, offset: float = 0.0, duration: float | None = None) -> np.ndarray:
+    if is_path(source):
+        y = read_pcm(source, target_sr, offset, duration) # Memory-maps plain PCM WAV/AIFF
+        if y is not None:
+            return y
+    return _to_mono(*_read_soundfile(source, offset, duration), target_sr)
+
+
+def decode_librosa(source, target_sr: int, offset: float = 0.0, duration: float | None = None) -> np.ndarray:
+    import librosa
+    y, sr = librosa.load(source, sr=None, mono=True, offset=offset, duration=duration)
+    return _to_mono(y, sr, target_sr)
+
+
+BACKENDS: dict[str, Callable[..., np.ndarray]] = {
+    "soundfile": decode_soundfile,
+    "ffmpeg": decode_ffmpeg,
+    "librosa": decode_librosa,
+}
+
+
+@dataclass
+class BackendStats:
+    successes: int = 0
+    failures: int = 0
+    seconds: float = 0.0 # Total time spent in the backend, failed attempts included
+
+    @property
+    def calls(self) -> int:
+        return self.successes + self.failures
+
+
+class DecoderStats:
+    """Thread-safe per-backend counters of decode attempts and the time they took"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict[str, BackendStats] = {}
+
+    def record(self, backend: str, ok: bool, seconds: float):
+        with self._lock:
+            s = self._stats.setdefault(backend, BackendStats())
+            s.successes += ok
+            s.failures += not ok
+            s.seconds += seconds
+
+    def merge(self, other: dict[str, BackendStats]):
+        with self._lock:
+            for backend, o in other.items():
+                s = self._stats.setdefault(backend, BackendStats())
+                s.successes += o.successes
+                s.failures += o.failures
+                s.seconds += o.seconds
+
+    def snapshot(self) -> dict[str, BackendStats]:
+        with self._lock:
+            return {k: BackendStats(v.successes, v.failures, v.seconds) for k, v in self._stats.items()}
+
+    def take(self) -> dict[str, BackendStats]:
+        """Return the counters and reset them"""
+        with self._lock:
+            stats, self._stats = self._stats, {}
+        return stats
+
+
+# Decodes in this process. `DecodePool` merges in its workers' counters.
+decoder_stats = DecoderStats()
+
+
+def decode(source, target_sr: int, decoder: str = "auto", offset: float = 0.0, duration: float | None = None) -> np.ndarray:
+    """Decode `source` to mono float32 at `target_sr`, trying the backends of `decoder_plan`"""
+    return _decode(source, target_sr, decoder_plan(source, decoder), offset, duration)
+
+
+def _decode(source, target_sr: int, plan: list[str], offset: float, duration: float | None, error: Exception | None = None) -> np.ndarray:
+    for backend in plan:
+        start = time.perf_counter()
+        try:
+            y = BACKENDS[backend](source, target_sr, offset, duration)
+        except Exception as e:
+            decoder_stats.record(backend, False, time.perf_counter() - start)
+            error = error or e # The first backend's error is usually the informative one
+            if hasattr(source, "seek"):
+                source.seek(0)
+            continue
+        decoder_stats.record(backend, True, time.perf_counter() - start)
+        return y
+    assert error is not None
+    raise error
+
+
+def decode_blocks(
+    source,
+    target_sr: int,
+    decoder: str = "auto",
+    offset: float = 0.0,
+    duration: float | None = None,
+) -> Iterator[np.ndarray]:
+    """Like `decode`, but yield the waveform in consecutive blocks
+
+    Files that go to libsndfile are read, downmixed and resampled a block at a time, so the
+    whole waveform never needs to be in memory. Other backends yield it as a single block.
+    Blocks may be reused, so consume each one before asking for the next.
+
+    If libsndfile fails before its first block, the other backends are tried as in `decode`.
+    A failure after that is raised, since the blocks already yielded can't be taken back.
+    """
+    plan = decoder_plan(source, decoder)
+    if plan[0] != "soundfile":
+        yield _decode(source, target_sr, plan, offset, duration)
+        return
+
+    start = time.perf_counter()
+    blocks = None
+    try:
+        layout = pcm_layout(source) if is_path(source) else None
+        if layout is not None:
+            blocks = iter_pcm(source, target_sr, layout, offset, duration) # type: ignore[arg-type]
+        else:
+            blocks = _resampled(sf.SoundFile(source), target_sr, offset, duration)
+        first = next(blocks, None)
+    except Exception as e:
+        if blocks is not None:
+            blocks.close()
+        decoder_stats.record("soundfile", False, time.perf_counter() - start)
+        if len(plan) == 1:
+            raise
+        if hasattr(source, "seek"):
+            source.seek(0)
+        yield _decode(source, target_sr, plan[1:], offset, duration, error=e)
+        return
+
+    yield from _timed(blocks, "soundfile", time.perf_counter() - start, first)
+
+
+def _resampled(f: sf.SoundFile, target_sr: int, offset: float, duration: float | None) -> Iterator[np.ndarray]:
+    with f:
+        if f.samplerate == target_sr:
+            yield from _soundfile_blocks(f, offset, duration)
+            return
+        with stream(f.samplerate, target_sr) as resampler:
+            for y in _soundfile_blocks(f, offset, duration):
+                yield resampler.resample_chunk(y)
+            yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def _timed(blocks: Iterator[np.ndarray], backend: str, elapsed: float = 0.0, first: np.ndarray | None = None) -> Iterator[np.ndarray]:
+    """Pass `first` (if any) and then `blocks` through, counting the time spent producing them
+    (not consuming them) in `decoder_stats`"""
+    ok = False
+    try:
+        if first is not None:
+            yield first
+        while True:
+            start = time.perf_counter()
+            try:
+                y = next(blocks)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield y
+        ok = True
+    except GeneratorExit:
+        ok = True # The caller stopped early
+        raise
+    finally:
+        if hasattr(blocks, "close"):
+            blocks.close() # type: ignore[attr-defined]
+        decoder_stats.record(backend, ok, elapsed)
@@ -0,0 +1,329 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+_CHUNK = 16384 # Rows per distance computation, bounds temporary memory
+
+
+def _save_atomic(target: Path, arr: np.ndarray):
+    """`np.save` through a temp file and rename, so `arr` may be memory-mapped from `target`"""
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f"{target.stem}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _sq_norms(x: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", x, x)
+
+
+def _nearest(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid for each row of `x`"""
+    c_norms = _sq_norms(centroids)
+    out = np.empty(len(x), dtype=np.int64)
+    for b in range(0, len(x), _CHUNK):
+        d = c_norms[None, :] - 2 * (x[b:b + _CHUNK] @ centroids.T)
+        out[b:b + _CHUNK] = d.argmin(axis=1)
+    return out
+
+
+def _kmeans(x: np.ndarray, k: int, n_iter: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest(x, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        filled = counts > 0
+        sums = np.add.reduceat(x[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        # Move centroids that lost all their points onto random points
+        centroids[~filled] = x[rng.choice(len(x), int((~filled).sum()), replace=False)]
+    return centroids
+
+
+class EmbeddingIndex:
+    """Approximate nearest-neighbour index over track embeddings (IVF with product quantization)
+
+    Vectors are assigned to the nearest of `n_lists` coarse centroids, and their residual to
+    that centroid is compressed to `n_subvectors` bytes. A query scans only the `n_probe`
+    lists nearest to it, comparing against the compressed codes through per-list lookup
+    tables, so a million 256-d embeddings take about 24 MB and a query reads a few percent
+    of them.
+
+    With `normalize` (the default), vectors are scaled to unit length so that distances
+    rank by cosine similarity, which is approximately `1 - distance / 2`.
+
+    Compressed distances only roughly order close neighbours. With `store_vectors`, a float16
+    copy of every vector (512 bytes each at 256-d) is kept as well, and each query's shortlist
+    is re-ranked by exact distance.
+
+    Usage:
+        index = EmbeddingIndex()
+        index.train(vectors)
+        index.add(vectors, ids)
+        ids, distances = index.search(model.embed(["query.mp3"]), k=10)
+    """
+    def __init__(
+        self,
+        dim: int = 256,
+        n_lists: int = 1024,
+        n_subvectors: int = 16,
+        normalize: bool = True,
+        store_vectors: bool = False,
+    ):
+        if dim % n_subvectors:
+            raise ValueError(f"dim ({dim}) must be divisible by n_subvectors ({n_subvectors})")
+
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.normalize = normalize
+        self.store_vectors = store_vectors
+
+        self.centroids: np.ndarray | None = None # [n_lists, dim]
+        self.codebooks: np.ndarray | None = None # [n_subvectors, ksub, dim / n_subvectors]
+
+        # Indexed vectors are grouped by list, so list i is rows offsets[i]:offsets[i + 1]
+        self._codes = np.empty((0, n_subvectors), dtype=np.uint8)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = np.empty((0, dim), dtype=np.float16)
+        self._offsets = np.zeros(n_lists + 1, dtype=np.int64)
+
+        # Vectors added since the last compaction, scanned linearly until merged into the lists
+        self._pending: list[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+        self._n_pending = 0
+
+    def __len__(self) -> int:
+        return len(self._ids) + self._n_pending
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def _prepare(self, vectors) -> np.ndarray:
+        x = np.asarray(vectors, dtype=np.float32)
+        if x.ndim == 1:
+            x = x[None, :]
+        if x.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {x.shape[1]}")
+        if self.normalize:
+            x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        return x
+
+    def train(self, vectors, n_iter: int = 20, max_samples: int = 100_000, seed: int = 0):
+        """Learn the coarse centroids and PQ codebooks from a representative sample of vectors"""
+        if len(self):
+            raise RuntimeError("EmbeddingIndex can only be trained while empty")
+
+        x = self._prepare(vectors)
+        rng = np.random.default_rng(seed)
+        if len(x) > max_samples:
+            x = x[rng.choice(len(x), max_samples, replace=False)]
+
+        # With fewer vectors than lists, each vector gets its own list
+        self.n_lists = min(self.n_lists, len(x))
+        self._offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        self.centroids = _kmeans(x, self.n_lists, n_iter, rng)
+
+        residuals = x - self.centroids[_nearest(x, self.centroids)]
+        ksub = min(256, len(x))
+        sub = self.dim // self.n_subvectors
+        self.codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(residuals[:, j * sub:(j + 1) * sub]), ksub, n_iter, rng)
+            for j in range(self.n_subvectors)
+        ])
+
+    def _encode(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        assert self.centroids is not None and self.codebooks is not None
+        lists = _nearest(x, self.centroids)
+        residuals = x - self.centroids[lists]
+        sub = self.dim // self.n_subvectors
+        codes = np.stack([
+            _nearest(np.ascontiguousarray(residuals[:, j * sub:(j + 1) * sub]), self.codebooks[j])
+            for j in range(self.n_subvectors)
+        ], axis=1).astype(np.uint8)
+        return lists, codes
+
+    def add(self, vectors, ids=None) -> np.ndarray:
+        """Insert vectors, returning their ids (consecutive from `len(self)` if not given)"""
+        if not self.is_trained:
+            raise RuntimeError("EmbeddingIndex must be trained before adding vectors")
+
+        x = self._prepare(vectors)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(x), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.shape != (len(x),):
+            raise ValueError("Expected one id per vector")
+
+        lists, codes = self._encode(x)
+        vectors = x.astype(np.float16) if self.store_vectors else np.empty((len(x), 0), dtype=np.float16)
+        self._pending.append((lists, codes, ids, vectors))
+        self._n_pending += len(x)
+
+        # Merging costs a pass over the whole index, so only do it once pending vectors
+        # make up a noticeable share of each query's linear scan
+        if self._n_pending > max(10_000, len(self._ids) // 20):
+            self.compact()
+        return ids
+
+    def compact(self):
+        """Merge vectors added since the last compaction into the inverted lists"""
+        if not self._pending:
+            return
+
+        lists = np.concatenate([np.repeat(np.arange(self.n_lists), np.diff(self._offsets)), *(p[0] for p in self._pending)])
+        codes = np.concatenate([self._codes, *(p[1] for p in self._pending)])
+        ids = np.concatenate([self._ids, *(p[2] for p in self._pending)])
+
+        order = np.argsort(lists, kind="stable")
+        self._codes = codes[order]
+        self._ids = ids[order]
+        if self.store_vectors:
+            self._vectors = np.concatenate([self._vectors, *(p[3] for p in self._pending)])[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.n_lists))])
+        self._pending = []
+        self._n_pending = 0
+
+    def search(self, queries, k: int = 10, n_probe: int = 16, rerank: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Find the `k` nearest indexed vectors to each query
+
+        Returns `(ids, distances)`, both `[n_queries, k]` and sorted nearest first. Rows are
+        padded with id -1 and infinite distance when fewer than `k` vectors were scanned.
+        Raising `n_probe` scans more lists, trading speed for recall. With stored vectors, the
+        `rerank` (default `4 * k`) best compressed matches are re-ranked by exact distance.
+        """
+        if not self.is_trained:
+            raise RuntimeError("EmbeddingIndex must be trained before searching")
+        assert self.centroids is not None and self.codebooks is not None
+
+        q = self._prepare(queries)
+        n_probe = min(n_probe, self.n_lists)
+        sub = self.dim // self.n_subvectors
+        ksub = self.codebooks.shape[1]
+
+        # Coarse step for the whole batch at once
+        coarse = _sq_norms(self.centroids)[None, :] - 2 * (q @ self.centroids.T)
+        probes = np.argpartition(coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        shortlist = max(k, rerank if rerank is not None else 4 * k) if self.store_vectors else k
+
+        pending = None
+        if self._pending:
+            pending = tuple(np.concatenate(parts) for parts in zip(*self._pending))
+        n_base = len(self._ids)
+
+        out_ids = np.full((len(q), k), -1, dtype=np.int64)
+        out_dist = np.full((len(q), k), np.inf, dtype=np.float32)
+        cb_norms = np.einsum("mkd,mkd->mk", self.codebooks, self.codebooks)
+        flat = np.arange(self.n_subvectors) * ksub
+
+        for qi in range(len(q)):
+            lists = probes[qi]
+
+            # ||r - c||^2 per list, subspace and codeword, where r is the query's residual
+            r = (q[qi][None, :] - self.centroids[lists]).reshape(len(lists), self.n_subvectors, sub)
+            tables = (
+                np.einsum("pmd,pmd->pm", r, r)[:, :, None]
+                - 2 * np.einsum("pmd,mkd->pmk", r, self.codebooks)
+                + cb_norms[None]
+            ).reshape(len(lists), -1)
+
+            starts, ends = self._offsets[lists], self._offsets[lists + 1]
+            sizes = ends - starts
+            rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if sizes.sum() else np.empty(0, dtype=np.int64)
+            codes = self._codes[rows]
+            which = np.repeat(np.arange(len(lists)), sizes)
+
+            if pending is not None:
+                pos = {lst: i for i, lst in enumerate(lists.tolist())}
+                hit = np.flatnonzero(np.isin(pending[0], lists))
+                codes = np.concatenate([codes, pending[1][hit]])
+                which = np.concatenate([which, [pos[lst] for lst in pending[0][hit].tolist()]]).astype(np.int64)
+                rows = np.concatenate([rows, n_base + hit]) # Pending vectors are numbered after the lists
+
+            if not len(rows):
+                continue
+
+            dist = tables[which[:, None], flat[None, :] + codes].sum(axis=1)
+            top = np.argpartition(dist, min(shortlist, len(dist)) - 1)[:shortlist]
+            rows, dist = rows[top], dist[top]
+
+            if self.store_vectors:
+                vectors = self._gather(self._vectors, pending[3] if pending else None, rows, n_base)
+                dist = _sq_norms(vectors.astype(np.float32) - q[qi][None, :])
+
+            top = np.argsort(dist)[:k]
+            out_ids[qi, :len(top)] = self._gather(self._ids, pending[2] if pending else None, rows[top], n_base)
+            out_dist[qi, :len(top)] = dist[top]
+
+        return out_ids, out_dist
+
+    @staticmethod
+    def _gather(base: np.ndarray, pending: np.ndarray | None, rows: np.ndarray, n_base: int) -> np.ndarray:
+        in_base = rows < n_base
+        if pending is None or in_base.all():
+            return base[rows]
+        out = np.empty((len(rows), *base.shape[1:]), dtype=base.dtype)
+        out[in_base] = base[rows[in_base]]
+        out[~in_base] = pending[rows[~in_base] - n_base]
+        return out
+
+    def save(self, path: str | Path):
+        """Write the index to directory `path`, merging any pending vectors first"""
+        if not self.is_trained:
+            raise RuntimeError("EmbeddingIndex must be trained before saving")
+        self.compact()
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "format": FORMAT_VERSION,
+            "dim": self.dim,
+            "n_lists": self.n_lists,
+            "n_subvectors": self.n_subvectors,
+            "normalize": self.normalize,
+            "store_vectors": self.store_vectors,
+        }
+        arrays = {
+            "centroids": self.centroids,
+            "codebooks": self.codebooks,
+            "codes": self._codes,
+            "ids": self._ids,
+            "offsets": self._offsets,
+        }
+        if self.store_vectors:
+            arrays["vectors"] = self._vectors
+        for name, arr in arrays.items():
+            _save_atomic(path / f"{name}.npy", arr)
+        (path / "meta.json").write_text(json.dumps(meta))
+
+    @classmethod
+    def load(cls, path: str | Path, mmap: bool = True) -> "EmbeddingIndex":
+        """Open an index written by `save`. With `mmap`, the codes stay on disk until read."""
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format {meta.get('format')!r} in {path}")
+
+        index = cls(meta["dim"], meta["n_lists"], meta["n_subvectors"], meta["normalize"], meta["store_vectors"])
+        mode = "r" if mmap else None
+        index.centroids = np.load(path / "centroids.npy")
+        index.codebooks = np.load(path / "codebooks.npy")
+        index._codes = np.load(path / "codes.npy", mmap_mode=mode)
+        index._ids = np.load(path / "ids.npy", mmap_mode=mode)
+        index._offsets = np.load(path / "offsets.npy")
+        if index.store_vectors:
+            index._vectors = np.load(path / "vectors.npy", mmap_mode=mode)
+        return index
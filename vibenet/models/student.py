@@ -4,6 +4,8 @@ import torch.nn.functional as F
 from torch import nn
 from torchvggish import vggish
 from torchvision.models import efficientnet_b0
+from torchvision.models.efficientnet import MBConv
+from torchvision.ops import Conv2dNormActivation, SqueezeExcitation
 
 from vibenet import labels
 
@@ -26,14 +28,64 @@ class EfficientNetRegressor(nn.Module):
         
         self.heads = nn.ModuleDict({n: nn.Linear(256, 1) for n in labels})
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, lengths: torch.Tensor | None = None, return_embedding: bool = False):
         x = x.unsqueeze(1)
         x = x.repeat(1, 3, 1, 1) # (batch_size, 3, n_mels, time)
 
-        x = self.backbone(x)
+        if lengths is None:
+            x = self.backbone(x)
+        else:
+            x = self.masked_pool(*self.masked_features(x, lengths))
         x = self.trunk(x)
 
         outs = [self.heads[n](x) for n in labels]
         out = torch.cat(outs, dim=1)
         
-        return out
\ No newline at end of file
+        if return_embedding:
+            return out, x # The 256-d trunk output the heads share
+        return out
+    
+    def masked_features(self, x: torch.Tensor, lengths: torch.Tensor):
+        """Run the backbone's features so that frames past `lengths` have no effect on the rest.
+        
+        Padded frames are zeroed before every convolution that spans time, matching the zero
+        padding an unpadded input gets at its end, and squeeze-excitation pools only over valid
+        frames. Returns the features and the number of valid feature frames per row.
+        """
+        valid = lengths.clamp(min=1, max=x.shape[-1])
+        for stage in self.backbone.features:
+            # The stem and head are single Conv2dNormActivations (themselves Sequentials), the rest stages of MBConvs
+            for layer in [stage] if isinstance(stage, Conv2dNormActivation) else stage:
+                x, valid = self._masked(layer, x, valid)
+        return x, valid
+    
+    def _masked(self, layer: nn.Module, x: torch.Tensor, valid: torch.Tensor):
+        if isinstance(layer, MBConv):
+            h, v = x, valid
+            for sub in layer.block:
+                h, v = self._masked(sub, h, v)
+            if layer.use_res_connect:
+                h = layer.stochastic_depth(h) + x
+            return h, v
+        
+        if isinstance(layer, SqueezeExcitation):
+            pooled = self.masked_pool(x, valid)[:, :, None, None]
+            scale = layer.scale_activation(layer.fc2(layer.activation(layer.fc1(pooled))))
+            return scale * x, valid
+        
+        assert isinstance(layer, Conv2dNormActivation)
+        conv = layer[0]
+        if conv.kernel_size[1] > 1:
+            x = x * self._mask(x, valid)
+        # A stride-s convolution padded to keep "same" size maps n frames to ceil(n / s)
+        stride = conv.stride[1]
+        return layer(x), torch.div(valid + stride - 1, stride, rounding_mode='floor')
+    
+    def masked_pool(self, h: torch.Tensor, valid: torch.Tensor):
+        """Global average pool over only the first `valid` feature frames of each row"""
+        summed = (h * self._mask(h, valid)).sum(dim=(2, 3))
+        return summed / (valid.to(h.dtype) * h.shape[2])[:, None]
+    
+    def _mask(self, h: torch.Tensor, valid: torch.Tensor):
+        """A `[B, 1, 1, T]` mask of ones over the first `valid` frames of each row"""
+        return (torch.arange(h.shape[-1], device=h.device)[None, :] < valid[:, None]).to(h.dtype)[:, None, None, :]
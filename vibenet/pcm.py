@@ -0,0 +1,195 @@
+import os
+import struct
+from contextlib import nullcontext
+from dataclasses import dataclass
+from os import PathLike
+from typing import Iterator
+
+import numpy as np
+
+from vibenet.resample import stream
+
+BLOCK_FRAMES = 64 * 1024 # Frames converted, downmixed and resampled at a time
+
+# Integer samples are scaled like libsndfile does, so both paths give the same waveform
+_SCALE = {1: 1 / 128, 2: 1 / 32768, 3: 1 / 2**31, 4: 1 / 2**31}
+
+
+@dataclass
+class PcmLayout:
+    """Where and how the samples of an uncompressed PCM file are stored"""
+    offset: int # Byte offset of the first frame
+    frames: int
+    channels: int
+    samplerate: int
+    width: int # Bytes per sample
+    kind: str # "i" for signed and "u" for unsigned integers, "f" for IEEE floats
+    big_endian: bool
+
+
+def _chunks(f, big_endian: bool, end: int):
+    fmt = ">4sI" if big_endian else "<4sI"
+    while f.tell() + 8 <= end:
+        cid, size = struct.unpack(fmt, f.read(8))
+        start = f.tell()
+        yield cid, start, size
+        f.seek(start + size + (size & 1)) # Chunks are padded to an even size
+
+
+def _parse_wav(f, end: int) -> PcmLayout | None:
+    fmt = data = None
+    for cid, start, size in _chunks(f, False, end):
+        if cid == b"fmt " and size >= 16:
+            tag, channels, sr, _, align, bits = struct.unpack("<HHIIHH", f.read(16))
+            if tag == 0xFFFE and size >= 40: # WAVE_FORMAT_EXTENSIBLE, the real tag leads the subformat GUID
+                f.seek(start + 24)
+                (tag,) = struct.unpack("<H", f.read(2))
+            fmt = tag, channels, sr, align, bits
+        elif cid == b"data":
+            data = start, min(size, end - start) # Streamed files may not have a real size
+            break
+    if fmt is None or data is None:
+        return None
+
+    tag, channels, sr, align, bits = fmt
+    width = bits // 8
+    if channels < 1 or bits % 8 or align != channels * width:
+        return None
+    if tag == 1 and width in (1, 2, 3, 4):
+        kind = "u" if width == 1 else "i"
+    elif tag == 3 and width in (4, 8):
+        kind = "f"
+    else:
+        return None # Compressed, or an unusual layout that libsndfile handles
+    return PcmLayout(data[0], data[1] // align, channels, sr, width, kind, False)
+
+
+def _extended(b: bytes) -> float:
+    """Decode the 80-bit IEEE extended float AIFF stores its sample rate in"""
+    exponent = ((b[0] & 0x7F) << 8) | b[1]
+    mantissa = int.from_bytes(b[2:10], "big")
+    return (-1 if b[0] & 0x80 else 1) * mantissa * 2.0 ** (exponent - 16383 - 63)
+
+
+def _parse_aiff(f, end: int, aifc: bool) -> PcmLayout | None:
+    comm = ssnd = None
+    for cid, start, size in _chunks(f, True, end):
+        if cid == b"COMM" and size >= 18:
+            channels, frames, bits = struct.unpack(">HIH", f.read(8))
+            sr = _extended(f.read(10))
+            compression = f.read(4) if aifc and size >= 22 else b"NONE"
+            comm = channels, frames, bits, sr, compression
+        elif cid == b"SSND" and size >= 8:
+            (skip,) = struct.unpack(">I", f.read(4))
+            ssnd = start + 8 + skip, min(size, end - start) - 8 - skip
+    if comm is None or ssnd is None:
+        return None
+
+    channels, frames, bits, sr, compression = comm
+    width = (bits + 7) // 8
+    if channels < 1 or sr != int(sr):
+        return None
+    big_endian = True
+    if compression == b"NONE" and width in (1, 2, 3, 4):
+        kind = "i"
+    elif compression == b"sowt" and width in (2, 3, 4):
+        kind, big_endian = "i", False
+    elif compression in (b"fl32", b"FL32") and width == 4 or compression in (b"fl64", b"FL64") and width == 8:
+        kind = "f"
+    else:
+        return None
+    frames = min(frames, ssnd[1] // (channels * width))
+    return PcmLayout(ssnd[0], frames, channels, int(sr), width, kind, big_endian)
+
+
+def pcm_layout(path: str | bytes | PathLike) -> PcmLayout | None:
+    """Parse the header of a WAV or AIFF file, or return None unless it holds plain PCM or float samples"""
+    try:
+        with open(path, "rb") as f:
+            end = os.fstat(f.fileno()).st_size
+            header = f.read(12)
+            if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+                layout = _parse_wav(f, end)
+            elif header[:4] == b"FORM" and header[8:12] in (b"AIFF", b"AIFC"):
+                layout = _parse_aiff(f, end, header[8:12] == b"AIFC")
+            else:
+                return None
+    except (OSError, struct.error):
+        return None
+    return layout if layout is not None and layout.frames > 0 and layout.samplerate > 0 else None
+
+
+def _to_float(block: np.ndarray, layout: PcmLayout) -> np.ndarray:
+    """Convert a `[frames, channels(, 3)]` block of stored samples to float32"""
+    if layout.width == 3:
+        lo, mid, hi = (2, 1, 0) if layout.big_endian else (0, 1, 2)
+        # Place the 24 bits at the top of an int32, which also sign-extends them
+        x = block[..., hi].astype(np.int32) << 24
+        x |= block[..., mid].astype(np.int32) << 16
+        x |= block[..., lo].astype(np.int32) << 8
+    elif layout.kind == "u":
+        x = block.astype(np.int16) - 128
+    else:
+        x = block
+    if layout.kind == "f":
+        return x.astype(np.float32, copy=False)
+    return x.astype(np.float32) * np.float32(_SCALE[layout.width])
+
+
+def iter_pcm(path: str | bytes | PathLike, target_sr: int, layout: PcmLayout, offset: float = 0.0, duration: float | None = None) -> Iterator[np.ndarray]:
+    """Yield the mono float32 waveform of a PCM file at `target_sr` in blocks, through a memory map
+
+    Samples are converted, downmixed and resampled `BLOCK_FRAMES` at a time. The blocks are
+    reused, so consume each one before asking for the next.
+    """
+    sr = layout.samplerate
+    start = min(int(offset * sr), layout.frames)
+    stop = layout.frames if duration is None else min(layout.frames, start + int(duration * sr))
+    if stop <= start:
+        return
+
+    order = ">" if layout.big_endian else "<"
+    if layout.width == 3:
+        dtype, shape = np.dtype(np.uint8), (layout.frames, layout.channels, 3)
+    else:
+        dtype, shape = np.dtype(f"{order}{layout.kind}{layout.width}"), (layout.frames, layout.channels)
+    samples = np.memmap(path, dtype=dtype, mode="r", offset=layout.offset, shape=shape)
+
+    with stream(sr, target_sr) if sr != target_sr else nullcontext() as resampler:
+        mono = np.empty(min(BLOCK_FRAMES, stop - start), dtype=np.float32)
+        for i in range(start, stop, BLOCK_FRAMES):
+            block = _to_float(samples[i:min(i + BLOCK_FRAMES, stop)], layout)
+            n = len(block)
+            if layout.channels == 1:
+                mono[:n] = block[:, 0]
+            else:
+                np.mean(block, axis=1, out=mono[:n])
+            yield mono[:n] if resampler is None else resampler.resample_chunk(mono[:n], last=i + BLOCK_FRAMES >= stop)
+
+
+def read_pcm(
+    path: str | bytes | PathLike,
+    target_sr: int,
+    offset: float = 0.0,
+    duration: float | None = None,
+    layout: PcmLayout | None = None,
+) -> np.ndarray | None:
+    """Decode a PCM WAV/AIFF file to mono float32 at `target_sr` through a memory map
+
+    Memory use is bounded by the output rather than the file, see `iter_pcm`. Returns None
+    for files this can't map, which are left to libsndfile.
+    """
+    layout = layout or pcm_layout(path)
+    if layout is None:
+        return None
+
+    sr = layout.samplerate
+    frames = layout.frames if duration is None else min(layout.frames, int(duration * sr))
+    out = np.empty(int(np.ceil(frames * target_sr / sr)) + 1, dtype=np.float32)
+    filled = 0
+    for y in iter_pcm(path, target_sr, layout, offset, duration):
+        if filled + len(y) > len(out):
+            out = np.resize(out, filled + len(y))
+        out[filled:filled + len(y)] = y
+        filled += len(y)
+    return out[:filled]
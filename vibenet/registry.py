@@ -0,0 +1,91 @@
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from vibenet.config import SessionConfig
+from vibenet.core import SAMPLE_RATE, Model
+
+Key = tuple[str, SessionConfig]
+
+
+@dataclass
+class _Entry:
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    model: Model | None = None
+    last_used: float = 0.0
+
+
+class ModelRegistry:
+    """Thread-safe cache of loaded models, one per (precision, session config).
+
+    Models are built lazily on first `get`, and kept until `release` is called or, if
+    `idle_timeout` is set, until they have not been requested for that many seconds.
+    Releasing only drops the registry's reference; callers still holding the model can
+    keep using it.
+    """
+    def __init__(self, idle_timeout: float | None = None):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._entries: dict[Key, _Entry] = {}
+        self._reaper: threading.Thread | None = None
+
+    def get(self, config: SessionConfig | None = None, precision: str = "fp32") -> Model:
+        key = (precision, config or SessionConfig())
+
+        with self._lock:
+            entry = self._entries.setdefault(key, _Entry())
+            self._start_reaper()
+
+        # Build outside the registry lock so other keys aren't blocked by a slow load
+        with entry.lock:
+            if entry.model is None:
+                from vibenet.backends import EfficientNetModel
+                entry.model = EfficientNetModel(config=key[1], precision=precision)
+            entry.last_used = time.monotonic()
+            return entry.model
+
+    def warmup(self, config: SessionConfig | None = None, precision: str = "fp32") -> Model:
+        """Load a model and run one prediction so the first real call doesn't pay for allocation"""
+        model = self.get(config, precision)
+        model.predict(np.zeros(SAMPLE_RATE, dtype=np.float32), SAMPLE_RATE)
+        return model
+
+    def release(self, config: SessionConfig | None = None, precision: str | None = None):
+        """Drop matching models, or every model if neither argument is given"""
+        with self._lock:
+            for key in list(self._entries):
+                if precision is not None and key[0] != precision:
+                    continue
+                if config is not None and key[1] != config:
+                    continue
+                del self._entries[key]
+
+    def _start_reaper(self):
+        if self.idle_timeout is None or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        self._reaper = threading.Thread(target=self._reap, name="vibenet-registry-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap(self):
+        while self.idle_timeout is not None:
+            time.sleep(max(1.0, self.idle_timeout / 4))
+
+            with self._lock:
+                cutoff = time.monotonic() - (self.idle_timeout or 0)
+                for key, entry in list(self._entries.items()):
+                    if entry.model is not None and entry.last_used < cutoff and not entry.lock.locked():
+                        del self._entries[key]
+
+                if not self._entries:
+                    self._reaper = None
+                    return
+
+
+default_registry = ModelRegistry()
+
+
+def get_model(config: SessionConfig | None = None, precision: str = "fp32") -> Model:
+    """Return the process-wide shared model for these settings, loading it on first use"""
+    return default_registry.get(config, precision)
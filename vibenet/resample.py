@@ -0,0 +1,58 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+import soxr
+
+# soxr quality recipes from fastest to most accurate
+QUALITIES = ("QQ", "LQ", "MQ", "HQ", "VHQ")
+
+_streams = threading.local()
+
+
+def default_quality() -> str:
+    """The resampling quality used when none is given, from `$VIBENET_RESAMPLE_QUALITY` (default "HQ")
+
+    Set through the environment so that decode worker processes pick it up too.
+    """
+    quality = os.environ.get("VIBENET_RESAMPLE_QUALITY", "HQ")
+    if quality not in QUALITIES:
+        raise ValueError(f"Unknown resampling quality {quality!r} in $VIBENET_RESAMPLE_QUALITY, expected one of {list(QUALITIES)}")
+    return quality
+
+
+@contextmanager
+def stream(in_sr: int, out_sr: int, channels: int = 1, quality: str | None = None, dtype="float32") -> Iterator[soxr.ResampleStream]:
+    """Borrow a cleared `soxr.ResampleStream` for this thread, reused across uses with the same parameters
+
+    Feed it with `resample_chunk` and pass `last=True` with the final block. Creating a soxr
+    resampler designs its filter, which costs about as much as resampling a short clip, so
+    streams are kept per thread rather than built for every file. A stream is taken out of
+    the cache for the duration of the `with` block, so streams that are in use at once (such
+    as two interleaved `decode_blocks` generators) each get their own.
+    """
+    quality = quality or default_quality()
+    key = (in_sr, out_sr, channels, quality, np.dtype(dtype).str)
+    idle: list = _streams.__dict__.setdefault("cache", {}).setdefault(key, [])
+    if idle:
+        s = idle.pop()
+        s.clear()
+    else:
+        s = soxr.ResampleStream(in_sr, out_sr, channels, dtype=dtype, quality=quality)
+    try:
+        yield s
+    finally:
+        idle.append(s)
+
+
+def resample(x: np.ndarray, in_sr: int, out_sr: int, quality: str | None = None) -> np.ndarray:
+    """Resample a `[T]` or `[T, channels]` float array, like `soxr.resample` but with a cached stream"""
+    if in_sr == out_sr:
+        return x
+    if x.dtype not in (np.float32, np.float64):
+        x = x.astype(np.float32)
+    channels = x.shape[1] if x.ndim == 2 else 1
+    with stream(in_sr, out_sr, channels, quality, x.dtype) as s:
+        return s.resample_chunk(x, last=True)
@@ -0,0 +1,216 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import vibenet
+from vibenet.batching import DynamicBatcher
+from vibenet.budget import available_cpus, plan_budget, set_thread_fft_workers
+from vibenet.core import InferenceResult
+
+_MAX_EXT = 8 # Longest upload extension kept as the temp file's suffix
+
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.tracks = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+    def record(self, tracks: int, failures: int, seconds: float):
+        with self._lock:
+            self.requests += 1
+            self.tracks += tracks
+            self.failures += failures
+            self.seconds += seconds
+
+    def render(self) -> str:
+        with self._lock:
+            return "".join([
+                f"vibenet_uptime_seconds {time.time() - self.started:.3f}\n",
+                f"vibenet_requests_total {self.requests}\n",
+                f"vibenet_tracks_total {self.tracks}\n",
+                f"vibenet_track_failures_total {self.failures}\n",
+                f"vibenet_request_seconds_total {self.seconds:.6f}\n",
+            ])
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """HTTP front end for a warm model, batching concurrent requests through a `DynamicBatcher`
+
+    Files are decoded and turned into mels on a pool of `decode_workers` threads, each using
+    `fft_workers` threads per FFT, then queued on the batcher, so the files of one request
+    decode in parallel.
+
+    Endpoints:
+        POST /predict: Raw audio file in the body. Pass `?ext=mp3` (or an `X-Filename` header)
+            when the format can't be sniffed from the contents
+        POST /predict: `{"paths": [...]}` JSON body with server-side paths, if `allow_paths`
+        GET /health: Liveness check
+        GET /metrics: Request counters in Prometheus text format
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        batcher: DynamicBatcher,
+        allow_paths: bool = False,
+        max_upload: int = 200 * 1024 * 1024,
+        decode_workers: int = 0,
+        fft_workers: int | None = None,
+    ):
+        super().__init__(address, _Handler)
+        self.batcher = batcher
+        self.decoder = ThreadPoolExecutor(
+            max_workers=decode_workers or available_cpus(), thread_name_prefix="vibenet-decode",
+            initializer=set_thread_fft_workers, initargs=(fft_workers,),
+        )
+        self.allow_paths = allow_paths
+        self.max_upload = max_upload
+        self.metrics = _Metrics()
+
+    def submit(self, item) -> "Future[Future[InferenceResult]]":
+        """Decode `item` on the decode pool and queue its mel, resolving to the batcher's future"""
+        return self.decoder.submit(self.batcher.submit, item)
+
+    def server_close(self):
+        super().server_close()
+        self.decoder.shutdown(cancel_futures=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: InferenceServer
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok"})
+        elif path == "/metrics":
+            self._send(HTTPStatus.OK, self.server.metrics.render().encode(), "text/plain; version=0.0.4")
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self._send_json(HTTPStatus.LENGTH_REQUIRED, {"error": "request body required"})
+            return
+        if length > self.server.max_upload:
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "upload too large"})
+            return
+
+        body = self.rfile.read(length)
+        start = time.perf_counter()
+
+        if self.headers.get_content_type() == "application/json":
+            status, payload, failures, tracks = self._predict_paths(body)
+        else:
+            status, payload, failures, tracks = self._predict_upload(body, url.query)
+
+        self.server.metrics.record(tracks, failures, time.perf_counter() - start)
+        self._send_json(status, payload)
+
+    def _predict_paths(self, body: bytes):
+        if not self.server.allow_paths:
+            return HTTPStatus.FORBIDDEN, {"error": "server-side paths are disabled, start with --allow-paths"}, 0, 0
+        try:
+            paths = json.loads(body)["paths"]
+            # Anything but a string would reach the decoders as a file object or descriptor
+            if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            return HTTPStatus.BAD_REQUEST, {"error": 'expected {"paths": [...]} with string paths'}, 0, 0
+
+        # Decode every path at once; each mel is queued as soon as it is ready, so they can share batches
+        futures = [(p, self.server.submit(p)) for p in paths]
+
+        rows, failures = [], 0
+        for p, fut in futures:
+            try:
+                rows.append({"path": p, **fut.result().result().to_dict()})
+            except Exception as e:
+                failures += 1
+                rows.append({"path": p, "error": str(e)})
+        return HTTPStatus.OK, rows, failures, len(paths)
+
+    def _predict_upload(self, body: bytes, query: str):
+        name = self.headers.get("X-Filename") or ""
+        ext = parse_qs(query).get("ext", [Path(name).suffix.lstrip(".")])[0]
+        if not (ext.isascii() and ext.isalnum() and len(ext) <= _MAX_EXT):
+            ext = "" # Only a format hint, so drop anything that could change the temp file's path
+
+        # Decoders such as audioread need a real file to read from
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=f".{ext}" if ext else "")
+        except OSError as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}, 1, 1
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            result = self.server.submit(tmp).result().result()
+        except Exception as e:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {"error": str(e)}, 1, 1
+        finally:
+            os.unlink(tmp)
+        return HTTPStatus.OK, result.to_dict(), 0, 1
+
+    def _send_json(self, status: HTTPStatus, payload):
+        self._send(status, json.dumps(payload).encode(), "application/json")
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep the console clean, request counts are on /metrics
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    config: vibenet.SessionConfig | None = None,
+    precision: str = "fp32",
+    max_batch_size: int = 16,
+    max_wait: float = 0.005,
+    runners: int = 1,
+    allow_paths: bool = False,
+    decode_workers: int = 0,
+    cpus: int = 0,
+):
+    """Load the model, warm it up and serve requests until interrupted
+
+    The decode pool and the batch runners run at once, so they split `cpus` (see
+    `vibenet.budget.plan_budget`). An `intra_op_threads` set in `config` is kept.
+    """
+    from vibenet.registry import default_registry
+
+    budget = plan_budget(decode_workers, runners=max(1, runners), cpus=cpus)
+    config = config or vibenet.SessionConfig()
+    config = replace(config, intra_op_threads=config.intra_op_threads or budget.intra_op_threads)
+
+    model = default_registry.warmup(config, precision)
+    with DynamicBatcher(model, max_batch_size=max_batch_size, max_wait=max_wait, runners=runners) as batcher: # type: ignore[arg-type]
+        with InferenceServer((host, port), batcher, allow_paths=allow_paths, decode_workers=budget.workers, fft_workers=budget.fft_workers) as httpd:
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass